@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Batch labeling of a folder of images with a Rekognition Custom Labels model.
+#
+# The lab calls `detect_custom_labels` by hand for `validation/2.jpeg` and
+# `validation/3.jpeg`, building a new client for every cell. `BatchLabeler`
+# takes every image under an S3 prefix or a local directory and labels them
+# with one client on a bounded thread pool. The number of calls in flight is
+# controlled by `AdaptiveLimiter`: it halves on a throttling error and grows
+# back by one after a window of successful calls, so a run settles at the
+# rate the model's inference units can take. Throttled and transient
+# failures are retried with jittered exponential backoff, and results are
+# streamed to a JSONL file, one line per image, as they come back. With a
+# `DetectionCache` images already labeled by the same model version are
+# answered locally, and with `--resize` local images are shrunk before
+# they are sent (see custom_labels_preprocess.py).
+#
+# `LocalRekognition` is a small stand-in for the Rekognition JSON API with a
+# configurable latency and throughput limit, for running the whole path
+# without a trained model.
+#
+# Usage:
+#     python custom_labels_batch.py s3://<your_bucket_name>/custom-model/validation/ --output labels.jsonl
+#     python custom_labels_batch.py validation/ --local-stub --workers 32
+
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from custom_labels_cache import DetectionCache, image_key
+
+REGION = 'us-west-2'
+MODEL_ARN = ('arn:aws:rekognition:us-west-2:065157574059:project/calabs-rekog/version/'
+             'calabs-rekog.2020-05-15T12.17.29/1589559450299')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Rekognition takes at most 4 MB of inline image bytes; larger images have to come from S3
+MAX_IMAGE_BYTES = 4 * 1024 * 1024
+
+THROTTLING_ERRORS = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException'}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {'InternalServerError', 'ServiceUnavailableException',
+                                        'ResourceNotReadyException'}
+
+
+def make_rekognition_client(endpoint_url=None, region_name=REGION, max_pool_connections=32):
+    """Return a boto3 Rekognition client; `endpoint_url` points it at a stand-in instead of AWS."""
+    import boto3
+    from botocore.config import Config
+
+    # a single attempt: BatchLabeler retries itself so it can adapt its concurrency to throttling
+    config = Config(max_pool_connections=max_pool_connections, retries={'max_attempts': 1, 'mode': 'standard'})
+    if endpoint_url:
+        return boto3.client('rekognition', endpoint_url=endpoint_url, region_name=region_name, config=config,
+                            aws_access_key_id='local', aws_secret_access_key='local')
+    return boto3.client('rekognition', region_name=region_name, config=config)
+
+
+def parse_s3_uri(uri):
+    """Split 's3://bucket/prefix' into `(bucket, prefix)`."""
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def list_images(source, s3_client=None, extensions=IMAGE_EXTENSIONS):
+    """Yield a reference for every image under an 's3://bucket/prefix' URI or a local directory.
+
+    A reference is a dict with the image's `id` (its S3 URI or path) and
+    either `path` or `S3Object`, plus the object's `etag` for S3 images.
+    """
+    if source.startswith('s3://'):
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        bucket, prefix = parse_s3_uri(source)
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].lower().endswith(extensions):
+                    yield {'id': 's3://{}/{}'.format(bucket, item['Key']),
+                           'S3Object': {'Bucket': bucket, 'Name': item['Key']},
+                           'etag': item.get('ETag', '').strip('"')}
+        return
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                path = os.path.join(root, name)
+                yield {'id': path, 'path': path}
+
+
+def image_param(ref):
+    """Build the `Image` argument of `detect_custom_labels` for an image reference."""
+    if 'error' in ref:
+        raise ValueError(ref['message'])
+    if 'Bytes' in ref:
+        return {'Bytes': ref['Bytes']}
+    if 'S3Object' in ref:
+        return {'S3Object': ref['S3Object']}
+    with open(ref['path'], 'rb') as image:
+        data = image.read()
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError('{} is {} bytes, over the {} byte limit for inline images'.format(
+            ref['path'], len(data), MAX_IMAGE_BYTES))
+    return {'Bytes': data}
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that backs off on throttling (AIMD).
+
+    At most `limit` callers hold the limiter at once. A throttled call
+    halves the limit (once per window of calls already in flight), and
+    every `limit` successful calls raise it by one, up to `max_limit`.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial=None):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = initial or max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.issued = 0
+        self.decreased_at = -1
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a slot is free; returns a ticket to pass to `release`."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            self.issued += 1
+            return self.issued
+
+    def release(self, ticket, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                # calls issued before the last decrease saw the old limit; don't punish twice for them
+                if ticket > self.decreased_at:
+                    self.limit = max(self.min_limit, self.limit // 2)
+                    self.decreased_at = self.issued
+                    self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class BatchLabeler:
+    """Labels many images on one Rekognition client with bounded, adaptive concurrency.
+
+    `label(refs)` yields one result per image reference, in completion
+    order: `{'image': id, 'CustomLabels': [...]}` or, once retries are
+    exhausted, `{'image': id, 'error': code}`. A `lifecycle`
+    (`custom_labels_model.ModelLifecycle`) is told about every detection,
+    so it can stop the model once the labeler goes quiet. With a `cache`
+    (`DetectionCache`) cached images skip the call and their results carry
+    `'cached': True`.
+    """
+
+    def __init__(self, client=None, model_arn=MODEL_ARN, max_workers=16, min_confidence=None,
+                 max_retries=8, backoff=0.1, max_backoff=10.0, lifecycle=None,
+                 cache=None):
+        self.client = client or make_rekognition_client(max_pool_connections=max_workers)
+        self.model_arn = model_arn
+        self.max_workers = max_workers
+        self.min_confidence = min_confidence
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lifecycle = lifecycle
+        self.cache = cache
+        self.limiter = AdaptiveLimiter(max_workers)
+        self.lock = threading.Lock()
+        self.stats = {'images': 0, 'labeled': 0, 'cached': 0, 'errors': 0, 'retries': 0, 'throttled': 0}
+
+    def _count(self, **counts):
+        with self.lock:
+            for name, n in counts.items():
+                self.stats[name] += n
+
+    def request(self, ref):
+        """Keyword arguments of the `detect_custom_labels` call for `ref`."""
+        params = {'ProjectVersionArn': self.model_arn, 'Image': image_param(ref)}
+        if self.min_confidence is not None:
+            params['MinConfidence'] = self.min_confidence
+        return params
+
+    def detect(self, ref):
+        """Label one image, retrying throttled and transient failures."""
+        from botocore.exceptions import (BotoCoreError, ClientError, ConnectionClosedError, ConnectTimeoutError,
+                                         EndpointConnectionError, ReadTimeoutError)
+
+        # connection and timeout failures may pass; anything else (e.g. ParamValidationError) never will
+        transient = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError)
+        started = time.perf_counter()
+        try:
+            key = image_key(ref) if self.cache is not None else None
+            if key is not None:
+                labels = self.cache.get(self.model_arn, key, self.min_confidence)
+                if labels is not None:
+                    self._count(images=1, labeled=1, cached=1)
+                    return {'image': ref['id'], 'CustomLabels': labels, 'cached': True}
+            params = self.request(ref)
+        except (OSError, ValueError) as error:
+            self._count(images=1, errors=1)
+            return {'image': ref['id'], 'error': type(error).__name__, 'message': str(error)}
+        for attempt in range(self.max_retries + 1):
+            ticket = self.limiter.acquire()
+            throttled = False
+            try:
+                response = self.client.detect_custom_labels(**params)
+            except ClientError as error:
+                code = error.response['Error']['Code']
+                throttled = code in THROTTLING_ERRORS
+                if code not in RETRYABLE_ERRORS or attempt == self.max_retries:
+                    self._count(images=1, errors=1, throttled=int(throttled))
+                    return {'image': ref['id'], 'error': code, 'message': str(error)}
+            except BotoCoreError as error:
+                code = type(error).__name__
+                if not isinstance(error, transient) or attempt == self.max_retries:
+                    self._count(images=1, errors=1)
+                    return {'image': ref['id'], 'error': code, 'message': str(error)}
+            else:
+                if self.lifecycle is not None:
+                    self.lifecycle.touch()
+                if key is not None:
+                    self.cache.put(self.model_arn, key, response['CustomLabels'], self.min_confidence)
+                self._count(images=1, labeled=1)
+                return {'image': ref['id'], 'CustomLabels': response['CustomLabels'],
+                        'attempts': attempt + 1, 'seconds': round(time.perf_counter() - started, 4)}
+            finally:
+                self.limiter.release(ticket, throttled)
+            self._count(retries=1, throttled=int(throttled))
+            # full jitter, so throttled callers don't come back in lockstep
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def label(self, refs):
+        """Yield a result for each image reference, keeping at most a few pool-fulls queued."""
+        refs = iter(refs)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set()
+            while True:
+                for ref in refs:
+                    pending.add(executor.submit(self.detect, ref))
+                    if len(pending) >= 2 * self.max_workers:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def label_to_jsonl(self, refs, path):
+        """Write one JSON line per image to `path` (or '-' for stdout) and return the run report."""
+        started = time.perf_counter()
+        out = open(path, 'w') if path != '-' else None
+        try:
+            for result in self.label(refs):
+                line = json.dumps(result, sort_keys=True)
+                if out is None:
+                    print(line)
+                else:
+                    out.write(line + '\n')
+        finally:
+            if out is not None:
+                out.close()
+            if self.cache is not None:
+                self.cache.flush()
+        elapsed = time.perf_counter() - started
+        report = dict(self.stats)
+        report.update(seconds=round(elapsed, 3),
+                      images_per_sec=round(report['images'] / elapsed, 1) if elapsed else None,
+                      concurrency=self.limiter.limit)
+        if self.cache is not None:
+            report['cache'] = self.cache.stats()
+        return report
+
+
+def stub_labels(image, label_names=('skyscrapers', 'suburbs')):
+    """Deterministic made-up detections for `LocalRekognition`.
+
+    S3 images whose key contains one of `label_names` get that label with
+    high confidence; anything else gets a label and confidence picked from
+    a checksum of the image.
+    """
+    if 'S3Object' in image:
+        key = image['S3Object']['Name']
+        for name in label_names:
+            if name in key.split('/'):
+                return [{'Name': name, 'Confidence': 90.0 + zlib.crc32(key.encode('utf-8')) % 1000 / 100}]
+        checksum = zlib.crc32(key.encode('utf-8'))
+    else:
+        checksum = zlib.crc32(base64.b64decode(image['Bytes']))
+    return [{'Name': label_names[checksum % len(label_names)], 'Confidence': 50.0 + checksum % 5000 / 100}]
+
+
+class _LocalRekognitionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        operation = self.headers.get('X-Amz-Target', '').rpartition('.')[2]
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        status, payload = self.server.dispatch(operation, body)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalRekognition(ThreadingHTTPServer):
+    """Rekognition Custom Labels stand-in on localhost, for `make_rekognition_client(endpoint_url=...)`.
+
+    Each `DetectCustomLabels` call takes `latency` seconds; more than `tps`
+    calls per second are answered with a `ThrottlingException`, the way an
+    under-provisioned model behaves. `labeler(image)` makes up the labels.
+
+    The version ARNs in `models` start out trained but stopped, and go
+    through STARTING (`start_seconds`) and STOPPING (`stop_seconds`) on
+    `StartProjectVersion`/`StopProjectVersion`; detecting with them while
+    they aren't RUNNING raises `ResourceNotReadyException`. Any other
+    version ARN is treated as already running.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0.05, tps=None, labeler=stub_labels, models=(), start_seconds=1.0,
+                 stop_seconds=0.5):
+        super().__init__(('127.0.0.1', port), _LocalRekognitionHandler)
+        self.latency = latency
+        self.tps = tps
+        self.labeler = labeler
+        self.start_seconds = start_seconds
+        self.stop_seconds = stop_seconds
+        # version ARN -> [status, time of the pending transition, MinInferenceUnits]
+        self.versions = {arn: ['TRAINING_COMPLETED', None, None] for arn in models}
+        self.lock = threading.Lock()
+        self.tokens = float(tps or 0)
+        self.refilled = time.monotonic()
+        self.calls = {}
+        self.thread = None
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def _take_token(self):
+        if not self.tps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.tps), self.tokens + (now - self.refilled) * self.tps)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def dispatch(self, operation, body):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        handler = getattr(self, 'op_' + operation, None)
+        if handler is None:
+            return 400, {'__type': 'InvalidParameterException', 'message': 'unsupported operation ' + operation}
+        return handler(body)
+
+    def _status(self, arn):
+        """Current status of a registered version, completing any transition that is due."""
+        with self.lock:
+            version = self.versions[arn]
+            if version[1] is not None and time.monotonic() >= version[1]:
+                version[0] = {'STARTING': 'RUNNING', 'STOPPING': 'STOPPED'}[version[0]]
+                version[1] = None
+            return version[0]
+
+    def op_DescribeProjects(self, body):
+        names = body.get('ProjectNames') or sorted({arn.split('/')[1] for arn in self.versions})
+        account = 'arn:aws:rekognition:{}:000000000000:project'.format(REGION)
+        return 200, {'ProjectDescriptions': [{'ProjectArn': '{}/{}/0'.format(account, name), 'Status': 'CREATED'}
+                                             for name in names]}
+
+    def op_DescribeProjectVersions(self, body):
+        project = body['ProjectArn'].split('/')[1]
+        names = body.get('VersionNames')
+        descriptions = []
+        for arn in list(self.versions):
+            _, name, _, version, _ = arn.split('/')
+            if name == project and (not names or version in names):
+                descriptions.append({'ProjectVersionArn': arn, 'Status': self._status(arn),
+                                     'MinInferenceUnits': self.versions[arn][2]})
+        return 200, {'ProjectVersionDescriptions': descriptions}
+
+    def op_StartProjectVersion(self, body):
+        arn = body['ProjectVersionArn']
+        if arn not in self.versions:
+            return 400, {'__type': 'ResourceNotFoundException', 'message': 'unknown version ' + arn}
+        if self._status(arn) not in ('TRAINING_COMPLETED', 'STOPPED'):
+            return 400, {'__type': 'ResourceInUseException', 'message': 'version is ' + self._status(arn)}
+        with self.lock:
+            self.versions[arn] = ['STARTING', time.monotonic() + self.start_seconds, body['MinInferenceUnits']]
+        return 200, {'Status': 'STARTING'}
+
+    def op_StopProjectVersion(self, body):
+        arn = body['ProjectVersionArn']
+        if arn not in self.versions:
+            return 400, {'__type': 'ResourceNotFoundException', 'message': 'unknown version ' + arn}
+        if self._status(arn) != 'RUNNING':
+            return 400, {'__type': 'ResourceInUseException', 'message': 'version is ' + self._status(arn)}
+        with self.lock:
+            self.versions[arn][:2] = ['STOPPING', time.monotonic() + self.stop_seconds]
+        return 200, {'Status': 'STOPPING'}
+
+    def op_DetectCustomLabels(self, body):
+        arn = body['ProjectVersionArn']
+        if arn in self.versions and self._status(arn) != 'RUNNING':
+            return 400, {'__type': 'ResourceNotReadyException', 'message': 'version is ' + self._status(arn)}
+        if not self._take_token():
+            return 400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'}
+        time.sleep(self.latency)
+        labels = self.labeler(body['Image'])
+        minimum = body.get('MinConfidence', 50.0)
+        return 200, {'CustomLabels': [label for label in labels if label['Confidence'] >= minimum]}
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Label every image under an S3 prefix or local directory.')
+    parser.add_argument('source', help="'s3://bucket/prefix' or a local directory")
+    parser.add_argument('--model-arn', default=MODEL_ARN)
+    parser.add_argument('--output', default='labels.jsonl', help="JSONL results, or '-' for stdout")
+    parser.add_argument('--workers', type=int, default=16, help='most detect calls in flight')
+    parser.add_argument('--min-confidence', type=float)
+    parser.add_argument('--max-retries', type=int, default=8)
+    parser.add_argument('--endpoint-url', help='Rekognition-compatible endpoint instead of AWS')
+    parser.add_argument('--local-stub', action='store_true', help='label against an in-process stand-in')
+    parser.add_argument('--stub-tps', type=float, help='throughput limit of the stand-in')
+    parser.add_argument('--start-model', action='store_true',
+                        help='start the model sized for the images found, and wait until it is RUNNING')
+    parser.add_argument('--deadline-minutes', type=float, default=10.0, help='sizing target for --start-model')
+    parser.add_argument('--stop-model', action='store_true', help='stop the model when labeling is done')
+    parser.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                        help='stop the model once no detection has been made for this long; '
+                             'without --stop-model, wait for that after labeling is done')
+    parser.add_argument('--cache', help='SQLite file of cached detections to reuse and extend')
+    parser.add_argument('--prune-cache', action='store_true', help="drop cached results of other model versions")
+    parser.add_argument('--resize', type=int, metavar='MAX_SIDE',
+                        help='shrink local images to this long edge and send them as bytes')
+    parser.add_argument('--jpeg-quality', type=int, default=90)
+    parser.add_argument('--resize-processes', type=int)
+    args = parser.parse_args(argv)
+
+    local = None
+    if args.local_stub:
+        local = LocalRekognition(tps=args.stub_tps, models=[args.model_arn] if args.start_model else ()).__enter__()
+    try:
+        client = make_rekognition_client(local.endpoint_url if local else args.endpoint_url,
+                                         max_pool_connections=args.workers)
+        refs, lifecycle, preprocessor = list_images(args.source), None, None
+        if args.resize:
+            from custom_labels_preprocess import Preprocessor
+
+            preprocessor = Preprocessor(args.resize, args.jpeg_quality, args.resize_processes)
+        cache = DetectionCache(args.cache) if args.cache else None
+        if cache is not None and args.prune_cache:
+            cache.prune(args.model_arn)
+        if args.start_model or args.stop_model or args.idle_timeout:
+            from custom_labels_model import ModelLifecycle, size_inference_units
+
+            lifecycle = ModelLifecycle(client, args.model_arn, poll_interval=1.0 if local else 30.0,
+                                       idle_timeout=args.idle_timeout, stop_on_exit=args.stop_model)
+            if args.start_model:
+                refs = list(refs)
+                variant = preprocessor.variant if preprocessor else None
+                queued = len(refs) if cache is None else sum(
+                    not cache.contains(args.model_arn, image_key(dict(ref, variant=variant)), args.min_confidence)
+                    for ref in refs)
+                # nothing to detect when every image is cached, so don't pay for the model
+                if queued:
+                    lifecycle.start(size_inference_units(queued, deadline_seconds=args.deadline_minutes * 60))
+            if args.idle_timeout:
+                watcher = lifecycle.watch_idle()
+        if preprocessor is not None:
+            # cached images are answered from the cache, so don't spend time shrinking them
+            cached = None if cache is None else cache.keys(args.model_arn, args.min_confidence)
+            refs = preprocessor.prepare(refs, cached)
+        labeler = BatchLabeler(client, args.model_arn, args.workers, args.min_confidence, args.max_retries,
+                               lifecycle=lifecycle, cache=cache)
+        try:
+            report = labeler.label_to_jsonl(refs, args.output)
+            if args.idle_timeout and not args.stop_model:
+                # keep the model up for a follow-up run until the idle timeout stops it
+                watcher.join()
+        finally:
+            if lifecycle is not None:
+                lifecycle.__exit__(None, None, None)
+            if cache is not None:
+                cache.close()
+        if lifecycle is not None:
+            report['model'] = lifecycle.report
+        if preprocessor is not None:
+            report['preprocess'] = preprocessor.report()
+        print(json.dumps(report, indent=2))
+    finally:
+        if local:
+            local.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    main()
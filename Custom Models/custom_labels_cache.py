@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persistent cache of Custom Labels detections.
+#
+# Every run of the lab sends the same validation images to
+# `detect_custom_labels` again, and each call is billed. `DetectionCache`
+# keeps the detections in a local SQLite file keyed by
+# (project version ARN, image content, MinConfidence). Local images are
+# identified by the SHA-256 of their bytes and S3 images by their ETag, so a
+# renamed or re-uploaded copy of the same image is still a hit, while an
+# edited image is a miss. A new model version has a different ARN, so its
+# results never mix with the old version's; `prune` drops the old rows.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# MinConfidence column value when the call leaves it to the model's own threshold
+DEFAULT_CONFIDENCE = -1.0
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as image:
+        for block in iter(lambda: image.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def image_key(ref):
+    """Content key of an image reference from `list_images`, or None if it can't be identified.
+
+    A local image sent preprocessed carries the preprocessing settings as
+    its `variant`, which becomes part of the key, and usually its `digest`
+    too, which saves reading the file again.
+    """
+    if 'S3Object' in ref:
+        return 'etag:' + ref['etag'] if ref.get('etag') else None
+    key = 'sha256:' + (ref.get('digest') or file_digest(ref['path']))
+    return key + ':' + ref['variant'] if ref.get('variant') else key
+
+
+class DetectionCache:
+    """SQLite-backed cache of `CustomLabels` lists.
+
+    Writes are buffered and committed every `flush_every` entries (and on
+    `flush`/`close`), so a labeling run doesn't pay a commit per image.
+    Safe to share between the labeler's threads.
+    """
+
+    def __init__(self, path, flush_every=200):
+        self.path = path
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS detections (
+                model_arn TEXT NOT NULL,
+                image_key TEXT NOT NULL,
+                min_confidence REAL NOT NULL,
+                detected_at REAL NOT NULL,
+                labels TEXT NOT NULL,
+                PRIMARY KEY (model_arn, image_key, min_confidence)
+            )
+        ''')
+        self.conn.commit()
+
+    @staticmethod
+    def _confidence(min_confidence):
+        return DEFAULT_CONFIDENCE if min_confidence is None else float(min_confidence)
+
+    def _lookup(self, model_arn, key, min_confidence):
+        entry = (model_arn, key, self._confidence(min_confidence))
+        row = self.conn.execute(
+            'SELECT labels FROM detections WHERE model_arn = ? AND image_key = ? AND min_confidence = ?',
+            entry).fetchone()
+        if row is None:
+            # an entry still waiting in the write buffer counts too
+            row = next(((labels,) for *pending, _, labels in self.pending if tuple(pending) == entry), None)
+        return row
+
+    def get(self, model_arn, key, min_confidence=None):
+        """Return the cached `CustomLabels` list, or None on a miss."""
+        with self.lock:
+            if key is None:
+                self.uncacheable += 1
+                return None
+            row = self._lookup(model_arn, key, min_confidence)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def contains(self, model_arn, key, min_confidence=None):
+        """Whether `get` would hit, without counting towards the statistics."""
+        if key is None:
+            return False
+        with self.lock:
+            return self._lookup(model_arn, key, min_confidence) is not None
+
+    def keys(self, model_arn, min_confidence=None):
+        """The set of image keys cached for `model_arn` at `min_confidence`."""
+        confidence = self._confidence(min_confidence)
+        with self.lock:
+            keys = {key for key, in self.conn.execute(
+                'SELECT image_key FROM detections WHERE model_arn = ? AND min_confidence = ?',
+                (model_arn, confidence))}
+            keys.update(key for arn, key, entry_confidence, _, _ in self.pending
+                        if (arn, entry_confidence) == (model_arn, confidence))
+        return keys
+
+    def put(self, model_arn, key, labels, min_confidence=None):
+        if key is None:
+            return
+        with self.lock:
+            self.pending.append((model_arn, key, self._confidence(min_confidence), time.time(), json.dumps(labels)))
+            if len(self.pending) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        self.conn.executemany('INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?)', self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self._flush()
+
+    def prune(self, keep_model_arn):
+        """Delete the entries of every model version but `keep_model_arn`; returns how many went."""
+        self.flush()
+        with self.lock:
+            deleted = self.conn.execute('DELETE FROM detections WHERE model_arn != ?', (keep_model_arn,)).rowcount
+            self.conn.commit()
+        return deleted
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM detections').fetchone()[0] + len(self.pending)
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'uncacheable': self.uncacheable,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+        }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
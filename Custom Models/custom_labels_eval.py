@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Evaluate Custom Labels detections against ground truth.
+#
+# The lab prints the raw `detect_custom_labels` response for one image at a
+# time, which says nothing about how good the model is. `Evaluation` loads
+# the JSONL written by custom_labels_batch.py and a ground-truth manifest
+# into NumPy arrays: an images x labels matrix of the highest confidence
+# detected, and a boolean matrix of the true labels. Precision, recall and
+# F1 per label, at a single threshold or over a whole sweep of thresholds,
+# then come from sorted arrays and `searchsorted`, with no loop over images
+# or detections, so tuning `MinConfidence` on a large validation set is
+# cheap.
+#
+# Ground truth can be:
+#     a Custom Labels / Ground Truth manifest   one JSON object per line, with `source-ref`
+#                                               and `<attribute>-metadata.class-name`
+#     a CSV file                                image,label rows (one row per label)
+#     folder names                              --labels-from-folders: the image's parent
+#                                               folder, as in the lab's automatic labelling
+#
+# Usage:
+#     python custom_labels_eval.py labels.jsonl --manifest output.manifest
+#     python custom_labels_eval.py labels.jsonl --labels-from-folders --sweep-csv sweep.csv
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+THRESHOLDS = np.arange(0.0, 100.5, 1.0)
+
+
+class Detections:
+    """Batch labeler results as flat arrays, one entry per detected label.
+
+    `images` and `names` list the image ids and label names in order of
+    appearance; `image_index`, `label_index` and `confidence` hold one
+    entry per detection. Failed images are left out and counted in
+    `errors`.
+    """
+
+    def __init__(self, images, names, image_index, label_index, confidence, errors=0):
+        self.images = images
+        self.names = names
+        self.image_index = np.asarray(image_index, dtype=np.int64)
+        self.label_index = np.asarray(label_index, dtype=np.int64)
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self.errors = errors
+
+    @classmethod
+    def from_jsonl(cls, paths):
+        """Read one or more JSONL files written by custom_labels_batch.py."""
+        images, image_ids = [], {}
+        names, name_ids = [], {}
+        image_index, label_index, confidence = [], [], []
+        errors = 0
+        for path in paths:
+            with open(path) as results:
+                for line in results:
+                    result = json.loads(line)
+                    if 'CustomLabels' not in result:
+                        errors += 1
+                        continue
+                    i = image_ids.setdefault(result['image'], len(images))
+                    if i == len(images):
+                        images.append(result['image'])
+                    for label in result['CustomLabels']:
+                        j = name_ids.setdefault(label['Name'], len(names))
+                        if j == len(names):
+                            names.append(label['Name'])
+                        image_index.append(i)
+                        label_index.append(j)
+                        confidence.append(label['Confidence'])
+        return cls(images, names, image_index, label_index, confidence, errors)
+
+
+def read_manifest(path):
+    """Yield `(image, label)` pairs from a Custom Labels / Ground Truth manifest."""
+    with open(path) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            for key, value in entry.items():
+                if key.endswith('-metadata') and isinstance(value, dict) and 'class-name' in value:
+                    yield entry['source-ref'], value['class-name']
+
+
+def read_label_csv(path):
+    """Yield `(image, label)` pairs from image,label CSV rows (a header row is skipped)."""
+    with open(path, newline='') as rows:
+        for row in csv.reader(rows):
+            if len(row) >= 2 and (row[0], row[1]) != ('image', 'label'):
+                yield row[0], row[1]
+
+
+def labels_from_folders(images):
+    """Yield `(image, label)` taking each image's parent folder name as its label."""
+    for image in images:
+        yield image, os.path.basename(os.path.dirname(image.rstrip('/')))
+
+
+class Evaluation:
+    """Detections and ground truth of one validation set, as NumPy arrays.
+
+    `scores[i, j]` is the highest confidence of label j detected on image
+    i (-1 if not detected) and `truth[i, j]` whether image i really has
+    label j. Only images present in both the results and the ground truth
+    are evaluated.
+    """
+
+    def __init__(self, detections, truth_pairs):
+        images, names = detections.images, detections.names
+        image_index, label_index, confidence = detections.image_index, detections.label_index, detections.confidence
+        truth_pairs = list(truth_pairs)
+        labels = list(names)
+        label_ids = {name: j for j, name in enumerate(labels)}
+        for _, name in truth_pairs:
+            if name not in label_ids:
+                label_ids[name] = len(labels)
+                labels.append(name)
+        image_ids = {image: i for i, image in enumerate(images)}
+
+        truth_image = np.fromiter((image_ids.get(image, -1) for image, _ in truth_pairs), dtype=np.int64,
+                                  count=len(truth_pairs))
+        truth_label = np.fromiter((label_ids[name] for _, name in truth_pairs), dtype=np.int64,
+                                  count=len(truth_pairs))
+        known = truth_image >= 0
+        evaluated = np.zeros(len(images), dtype=bool)
+        evaluated[truth_image[known]] = True
+
+        truth = np.zeros((len(images), len(labels)), dtype=bool)
+        truth[truth_image[known], truth_label[known]] = True
+        scores = np.full((len(images), len(labels)), -1.0)
+        # assign in increasing confidence, so the last (highest) write wins on repeated labels
+        order = np.argsort(confidence, kind='stable')
+        scores[image_index[order], label_index[order]] = confidence[order]
+
+        self.labels = labels
+        self.images = [image for image, keep in zip(images, evaluated) if keep]
+        self.truth = truth[evaluated]
+        self.scores = scores[evaluated]
+        self.unlabeled = int((~evaluated).sum())
+        self.missing = len({image for image, _ in truth_pairs if image not in image_ids})
+
+    def counts(self, thresholds):
+        """True positive, false positive and false negative counts, each labels x thresholds.
+
+        All labels and thresholds are counted in one pass: scores are
+        offset by a per-label stride, so a single sorted array and one
+        `searchsorted` per class (positives and negatives) answer every
+        (label, threshold) query.
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        n_labels = len(self.labels)
+        stride = 1000.0  # confidences are in [0, 100], misses are -1
+        offsets = np.arange(n_labels, dtype=np.float64) * stride
+        keyed = self.scores + offsets
+        queries = offsets[:, None] + thresholds[None, :]
+        upper = offsets[:, None] + stride / 2
+
+        def at_or_above(mask):
+            values = np.sort(keyed[mask])
+            return (np.searchsorted(values, upper, side='left')
+                    - np.searchsorted(values, queries, side='left'))
+
+        tp = at_or_above(self.truth)
+        fp = at_or_above(~self.truth)
+        fn = self.truth.sum(axis=0)[:, None] - tp
+        return tp, fp, fn
+
+    @staticmethod
+    def _ratios(tp, fp, fn):
+        # no predictions at all counts as precision 0 rather than undefined
+        precision = np.divide(tp, tp + fp, out=np.zeros(tp.shape), where=(tp + fp) > 0)
+        recall = np.divide(tp, tp + fn, out=np.zeros(tp.shape), where=(tp + fn) > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(tp.shape),
+                       where=(precision + recall) > 0)
+        return precision, recall, f1
+
+    def sweep(self, thresholds=THRESHOLDS):
+        """Per-label and micro-averaged precision/recall/F1 at every threshold, as arrays."""
+        tp, fp, fn = self.counts(thresholds)
+        precision, recall, f1 = self._ratios(tp, fp, fn)
+        micro = self._ratios(tp.sum(axis=0), fp.sum(axis=0), fn.sum(axis=0))
+        return {'thresholds': np.asarray(thresholds, dtype=np.float64), 'tp': tp, 'fp': fp, 'fn': fn,
+                'precision': precision, 'recall': recall, 'f1': f1,
+                'micro_precision': micro[0], 'micro_recall': micro[1], 'micro_f1': micro[2]}
+
+    def top1_accuracy(self):
+        """Share of single-label images whose highest-confidence detection is the true label."""
+        single = self.truth.sum(axis=1) == 1
+        if not single.any():
+            return None
+        detected = self.scores[single].max(axis=1) >= 0
+        correct = self.truth[single][np.arange(single.sum()), self.scores[single].argmax(axis=1)] & detected
+        return float(correct.mean())
+
+    def report(self, threshold=50.0, thresholds=THRESHOLDS):
+        """Metrics at `threshold`, and the best-F1 threshold of every label from a sweep."""
+        at = self.sweep([threshold])
+        swept = self.sweep(thresholds)
+        best = swept['f1'].argmax(axis=1)
+        labels = {}
+        for j, name in enumerate(self.labels):
+            labels[name] = {
+                'support': int(self.truth[:, j].sum()),
+                'tp': int(at['tp'][j, 0]), 'fp': int(at['fp'][j, 0]), 'fn': int(at['fn'][j, 0]),
+                'precision': round(float(at['precision'][j, 0]), 4),
+                'recall': round(float(at['recall'][j, 0]), 4),
+                'f1': round(float(at['f1'][j, 0]), 4),
+                'best_threshold': float(swept['thresholds'][best[j]]),
+                'best_f1': round(float(swept['f1'][j, best[j]]), 4),
+            }
+        best_micro = int(swept['micro_f1'].argmax())
+        accuracy = self.top1_accuracy()
+        return {
+            'images': len(self.images),
+            'unlabeled_images': self.unlabeled,
+            'missing_images': self.missing,
+            'threshold': threshold,
+            'micro': {'precision': round(float(at['micro_precision'][0]), 4),
+                      'recall': round(float(at['micro_recall'][0]), 4),
+                      'f1': round(float(at['micro_f1'][0]), 4)},
+            'macro_f1': round(float(at['f1'][:, 0].mean()), 4) if self.labels else None,
+            'top1_accuracy': None if accuracy is None else round(accuracy, 4),
+            'best_threshold': float(swept['thresholds'][best_micro]),
+            'best_micro_f1': round(float(swept['micro_f1'][best_micro]), 4),
+            'labels': labels,
+        }
+
+    def write_sweep_csv(self, path, thresholds=THRESHOLDS):
+        """Write label,threshold,tp,fp,fn,precision,recall,f1 rows for every label and threshold."""
+        swept = self.sweep(thresholds)
+        with open(path, 'w', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(['label', 'threshold', 'tp', 'fp', 'fn', 'precision', 'recall', 'f1'])
+            for j, name in enumerate(self.labels):
+                for k, threshold in enumerate(swept['thresholds']):
+                    writer.writerow([name, threshold, swept['tp'][j, k], swept['fp'][j, k], swept['fn'][j, k],
+                                     round(swept['precision'][j, k], 4), round(swept['recall'][j, k], 4),
+                                     round(swept['f1'][j, k], 4)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score Custom Labels detections against ground truth.')
+    parser.add_argument('results', nargs='+', help='JSONL written by custom_labels_batch.py')
+    truth = parser.add_mutually_exclusive_group(required=True)
+    truth.add_argument('--manifest', help='Custom Labels / Ground Truth manifest')
+    truth.add_argument('--labels-csv', help='image,label CSV')
+    truth.add_argument('--labels-from-folders', action='store_true', help="use each image's folder name")
+    parser.add_argument('--threshold', type=float, default=50.0, help='MinConfidence to report metrics at')
+    parser.add_argument('--step', type=float, default=1.0, help='threshold sweep step')
+    parser.add_argument('--sweep-csv', help='also write the full threshold sweep here')
+    args = parser.parse_args(argv)
+
+    detections = Detections.from_jsonl(args.results)
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+    elif args.labels_csv:
+        pairs = read_label_csv(args.labels_csv)
+    else:
+        pairs = labels_from_folders(detections.images)
+    evaluation = Evaluation(detections, pairs)
+    thresholds = np.arange(0.0, 100.0 + args.step / 2, args.step)
+    report = evaluation.report(args.threshold, thresholds)
+    report['failed_images'] = detections.errors
+    if args.sweep_csv:
+        evaluation.write_sweep_csv(args.sweep_csv, thresholds)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Start, size and stop a Rekognition Custom Labels model version.
+#
+# The lab calls `start_project_version(..., MinInferenceUnits=1)` and then
+# asks you to watch the console until the model is RUNNING; detections sent
+# before that fail with `ResourceNotReadyException`, and the model bills by
+# the inference-unit hour until someone deletes it. `ModelLifecycle` starts
+# the version, polls `describe_project_versions` until it is RUNNING, and
+# can stop it again once no detection has been made for `idle_timeout`
+# seconds. `size_inference_units` picks `MinInferenceUnits` from the number
+# of queued images and the throughput or deadline wanted.
+#
+# Usage:
+#     python custom_labels_model.py start --images 5000 --deadline-minutes 10
+#     python custom_labels_model.py start --ttl 3600      # stop again an hour after RUNNING
+#     python custom_labels_model.py status
+#     python custom_labels_model.py stop
+
+import argparse
+import json
+import math
+import threading
+import time
+
+from custom_labels_batch import MODEL_ARN, LocalRekognition, make_rekognition_client
+
+# rough detections per second one inference unit sustains; it depends on the model and image
+# size, so measure your own with custom_labels_batch.py and pass --tps-per-unit
+TPS_PER_INFERENCE_UNIT = 5.0
+MAX_INFERENCE_UNITS = 10
+
+
+class ModelNotReady(RuntimeError):
+    """The model version failed to start, or didn't reach the wanted status in time."""
+
+
+def parse_version_arn(model_arn):
+    """Split a project version ARN into `(project name, version name)`."""
+    parts = model_arn.split(':', 5)[5].split('/')
+    if len(parts) != 5 or parts[0] != 'project' or parts[2] != 'version':
+        raise ValueError('not a project version ARN: %r' % model_arn)
+    return parts[1], parts[3]
+
+
+def size_inference_units(queued_images, target_tps=None, deadline_seconds=None,
+                         tps_per_unit=TPS_PER_INFERENCE_UNIT, max_units=MAX_INFERENCE_UNITS):
+    """Inference units needed for `target_tps`, or to label `queued_images` within `deadline_seconds`."""
+    needed = target_tps or 0.0
+    if deadline_seconds:
+        needed = max(needed, queued_images / deadline_seconds)
+    return int(min(max_units, max(1, math.ceil(needed / tps_per_unit))))
+
+
+class ModelLifecycle:
+    """Starts a model version, waits until it is RUNNING and stops it when idle.
+
+    Call `touch()` whenever the model is used (`BatchLabeler` does, when
+    given the lifecycle); with `idle_timeout` set, a background thread stops
+    the version once it has been idle that long. Used as a context manager
+    it starts on entry and, with `stop_on_exit`, stops on exit.
+    """
+
+    def __init__(self, client=None, model_arn=MODEL_ARN, project_arn=None, min_units=1, max_units=None,
+                 poll_interval=30.0, start_timeout=3600.0, idle_timeout=None, stop_on_exit=False):
+        self.client = client or make_rekognition_client()
+        self.model_arn = model_arn
+        self.project_name, self.version_name = parse_version_arn(model_arn)
+        self.project_arn = project_arn
+        self.min_units = min_units
+        self.max_units = max_units
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+        self.idle_timeout = idle_timeout
+        self.stop_on_exit = stop_on_exit
+        self.last_used = time.monotonic()
+        self.closed = threading.Event()
+        self.watcher = None
+        self.report = {'started': False, 'seconds_to_running': None, 'inference_units': None,
+                       'stopped': False, 'stopped_idle': False}
+
+    def _project_arn(self):
+        if self.project_arn is None:
+            projects = self.client.describe_projects(ProjectNames=[self.project_name])['ProjectDescriptions']
+            if not projects:
+                raise ValueError('no project named %r' % self.project_name)
+            self.project_arn = projects[0]['ProjectArn']
+        return self.project_arn
+
+    def describe(self):
+        """Return the version's `ProjectVersionDescriptions` entry."""
+        versions = self.client.describe_project_versions(ProjectArn=self._project_arn(),
+                                                         VersionNames=[self.version_name])
+        for version in versions['ProjectVersionDescriptions']:
+            if version['ProjectVersionArn'] == self.model_arn:
+                return version
+        raise ValueError('no model version %r' % self.model_arn)
+
+    def status(self):
+        return self.describe()['Status']
+
+    def wait_for(self, statuses, timeout=None):
+        """Poll until the version is in one of `statuses`; returns that status."""
+        timeout = self.start_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self.describe()
+            status = version['Status']
+            if status in statuses:
+                return status
+            if status in ('FAILED', 'TRAINING_FAILED', 'DELETING', 'EXPIRED', 'DEPRECATED'):
+                raise ModelNotReady('{} is {}: {}'.format(self.model_arn, status, version.get('StatusMessage', '')))
+            if time.monotonic() >= deadline:
+                raise ModelNotReady('{} still {} after {:.0f}s'.format(self.model_arn, status, timeout))
+            time.sleep(self.poll_interval)
+
+    def start(self, min_units=None, wait=True):
+        """Start the version if it isn't running or starting; with `wait`, block until it is RUNNING.
+
+        A version that is already RUNNING is left as it is, even if it runs
+        on a different number of inference units.
+        """
+        units = min_units or self.min_units
+        started = time.monotonic()
+        status = self.status()
+        if status == 'STOPPING':
+            status = self.wait_for({'STOPPED'})
+        if status not in ('RUNNING', 'STARTING'):
+            params = {'ProjectVersionArn': self.model_arn, 'MinInferenceUnits': units}
+            if self.max_units:
+                params['MaxInferenceUnits'] = max(self.max_units, units)
+            self.client.start_project_version(**params)
+            self.report.update(started=True, inference_units=units)
+        if wait:
+            self.wait_for({'RUNNING'})
+            self.report['seconds_to_running'] = round(time.monotonic() - started, 1)
+        self.touch()
+        if self.idle_timeout:
+            self.watch_idle()
+        return self
+
+    def watch_idle(self):
+        """Start the background thread that stops the version after `idle_timeout` idle seconds.
+
+        Only `touch()` calls in this process count as use, so this belongs
+        in the process doing the detections.
+        """
+        if self.watcher is None:
+            self.touch()
+            self.closed.clear()
+            self.watcher = threading.Thread(target=self._watch_idle, daemon=True)
+            self.watcher.start()
+        return self.watcher
+
+    def wait_until_running(self, timeout=None):
+        return self.wait_for({'RUNNING'}, timeout)
+
+    def touch(self):
+        """Record that the model was just used."""
+        self.last_used = time.monotonic()
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_used
+
+    def _watch_idle(self):
+        while not self.closed.wait(min(self.poll_interval, self.idle_timeout / 4)):
+            if self.idle_seconds() >= self.idle_timeout:
+                self.stop()
+                self.report['stopped_idle'] = True
+                return
+
+    def stop(self, wait=False):
+        """Stop the version if it is running (or starting); billing ends once it is STOPPED."""
+        self.closed.set()
+        self.watcher = None
+        status = self.status()
+        if status == 'STARTING':
+            status = self.wait_for({'RUNNING', 'STOPPED'})
+        if status == 'RUNNING':
+            self.client.stop_project_version(ProjectVersionArn=self.model_arn)
+            self.report['stopped'] = True
+        if wait and status in ('RUNNING', 'STOPPING'):
+            self.wait_for({'STOPPED'})
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.stop_on_exit:
+            self.stop()
+        else:
+            self.closed.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Start, stop or check a Custom Labels model version.')
+    parser.add_argument('action', choices=['start', 'stop', 'status'])
+    parser.add_argument('--model-arn', default=MODEL_ARN)
+    parser.add_argument('--units', type=int, help='MinInferenceUnits (default: sized from --images)')
+    parser.add_argument('--max-units', type=int, help='MaxInferenceUnits, to let the model scale out')
+    parser.add_argument('--images', type=int, default=0, help='images queued for labeling')
+    parser.add_argument('--target-tps', type=float, help='detections per second wanted')
+    parser.add_argument('--deadline-minutes', type=float, help='label the queued images within this time')
+    parser.add_argument('--tps-per-unit', type=float, default=TPS_PER_INFERENCE_UNIT)
+    parser.add_argument('--poll-seconds', type=float, default=30.0)
+    parser.add_argument('--ttl', type=float, metavar='SECONDS',
+                        help='stay in the foreground and stop the model this long after it is RUNNING, '
+                             'whether or not it is in use (use --idle-timeout of custom_labels_batch.py '
+                             'to stop on inactivity)')
+    parser.add_argument('--no-wait', action='store_true', help="don't wait for RUNNING/STOPPED")
+    parser.add_argument('--local-stub', action='store_true', help='run against an in-process stand-in')
+    args = parser.parse_args(argv)
+
+    local = LocalRekognition(models=[args.model_arn]).__enter__() if args.local_stub else None
+    try:
+        client = make_rekognition_client(local.endpoint_url if local else None)
+        model = ModelLifecycle(client, args.model_arn, max_units=args.max_units, poll_interval=args.poll_seconds)
+        if args.action == 'start':
+            units = args.units or size_inference_units(
+                args.images, args.target_tps, args.deadline_minutes and args.deadline_minutes * 60,
+                args.tps_per_unit)
+            model.start(units, wait=not args.no_wait or args.ttl is not None)
+            if args.ttl is not None:
+                time.sleep(args.ttl)
+                model.stop(wait=not args.no_wait)
+        elif args.action == 'stop':
+            model.stop(wait=not args.no_wait)
+        report = dict(model.describe(), **model.report)
+        print(json.dumps(report, indent=2, sort_keys=True, default=str))
+    finally:
+        if local:
+            local.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    main()
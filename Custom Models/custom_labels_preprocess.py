@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shrink local images before sending them to a Custom Labels model.
+#
+# The lab points `detect_custom_labels` at full-size JPEGs in S3. The model
+# only looks at a downscaled copy of each image, so most of those bytes are
+# transferred and decoded for nothing. `Preprocessor` reads local images,
+# scales them down to at most `max_side` pixels on the long edge and
+# re-encodes them as JPEG for `Image={'Bytes': ...}`, which also labels
+# images that were never uploaded to S3. Decoding and resizing run in a
+# process pool, since Pillow holds the GIL for much of that work, and they
+# overlap with the detection calls. Images that are already small enough
+# are sent as they are. Each image is hashed in the pool as it is read; the
+# digest travels with the reference to the cache lookup, and images whose
+# detections are already cached are not decoded at all.
+#
+# Needs Pillow (`pip install pillow`).
+#
+# Usage:
+#     python custom_labels_preprocess.py validation/ --max-side 1024 --output-dir /tmp/shrunk
+#     python custom_labels_batch.py validation/ --resize 1024
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from custom_labels_batch import MAX_IMAGE_BYTES, list_images
+from custom_labels_cache import image_key
+
+# long edge, in pixels, that images are scaled down to by default
+DEFAULT_MAX_SIDE = 1024
+DEFAULT_QUALITY = 90
+
+
+def shrink_image(data, max_side=DEFAULT_MAX_SIDE, quality=DEFAULT_QUALITY):
+    """Return `(payload, width, height, resized)` for the encoded image `data`.
+
+    The image is scaled so its long edge is at most `max_side` pixels and
+    re-encoded as JPEG. If it is already that small and within the inline
+    size limit, the original bytes are returned unchanged.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        if max(width, height) <= max_side and len(data) <= MAX_IMAGE_BYTES:
+            return data, width, height, False
+        # let the JPEG decoder skip most of the pixels (DCT scaling) before the real resize
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=quality, optimize=True)
+        return out.getvalue(), image.size[0], image.size[1], True
+
+
+# image keys already in the detection cache, handed to every pool process once by `_init_worker`
+_cached_keys = frozenset()
+
+
+def _init_worker(cached_keys):
+    global _cached_keys
+    _cached_keys = cached_keys
+
+
+def _shrink_file(path, max_side, quality, variant):
+    with open(path, 'rb') as image:
+        data = image.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if image_key({'path': path, 'digest': digest, 'variant': variant}) in _cached_keys:
+        return None, None, None, False, len(data), digest
+    payload, width, height, resized = shrink_image(data, max_side, quality)
+    return payload, width, height, resized, len(data), digest
+
+
+class Preprocessor:
+    """Shrinks the local images of a reference stream in a process pool.
+
+    `prepare(refs)` yields the references in order, each local one with its
+    shrunk JPEG as `Bytes`, the SHA-256 `digest` of the original file and a
+    `variant` naming the settings, which `DetectionCache` folds into the
+    cache key. S3 references pass through untouched. Local images whose key
+    is in `cached` (`DetectionCache.keys`) are hashed but not shrunk, and
+    come back without `Bytes`. At most `lookahead` images are in the pool at
+    a time.
+    """
+
+    def __init__(self, max_side=DEFAULT_MAX_SIDE, quality=DEFAULT_QUALITY, processes=None, lookahead=None):
+        self.max_side = max_side
+        self.quality = quality
+        self.processes = processes or os.cpu_count() or 1
+        self.lookahead = lookahead or 4 * self.processes
+        self.variant = 'jpeg{}q{}'.format(max_side, quality)
+        self.stats = {'images': 0, 'resized': 0, 'skipped': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+                      'seconds': 0.0}
+
+    def _finish(self, ref, future):
+        try:
+            payload, width, height, resized, size, digest = future.result()
+        except Exception as error:  # an unreadable image fails its own detection, not the run
+            self.stats['errors'] += 1
+            return dict(ref, error=type(error).__name__, message=str(error), variant=self.variant)
+        if payload is None:
+            self.stats['skipped'] += 1
+            return dict(ref, digest=digest, variant=self.variant)
+        self.stats['images'] += 1
+        self.stats['resized'] += int(resized)
+        self.stats['bytes_in'] += size
+        self.stats['bytes_out'] += len(payload)
+        return dict(ref, Bytes=payload, size=[width, height], digest=digest, variant=self.variant)
+
+    def prepare(self, refs, cached=None):
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                 initargs=(frozenset(cached or ()),)) as executor:
+            window = deque()
+            for ref in refs:
+                if 'path' not in ref:
+                    window.append((ref, None))
+                else:
+                    window.append((ref, executor.submit(_shrink_file, ref['path'], self.max_side, self.quality,
+                                                        self.variant)))
+                while len(window) >= self.lookahead or (window and window[0][1] is None):
+                    ref, future = window.popleft()
+                    yield ref if future is None else self._finish(ref, future)
+            while window:
+                ref, future = window.popleft()
+                yield ref if future is None else self._finish(ref, future)
+        self.stats['seconds'] = time.perf_counter() - started
+
+    def report(self):
+        stats = self.stats
+        seconds = stats['seconds']
+        return {
+            'images': stats['images'],
+            'resized': stats['resized'],
+            'skipped': stats['skipped'],
+            'errors': stats['errors'],
+            'bytes_in': stats['bytes_in'],
+            'bytes_out': stats['bytes_out'],
+            'bytes_saved': stats['bytes_in'] - stats['bytes_out'],
+            'ratio': round(stats['bytes_out'] / stats['bytes_in'], 3) if stats['bytes_in'] else None,
+            'seconds': round(seconds, 3),
+            'images_per_sec': round(stats['images'] / seconds, 1) if seconds and stats['images'] else None,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shrink local images to the size a Custom Labels model uses.')
+    parser.add_argument('source', help='directory of images')
+    parser.add_argument('--max-side', type=int, default=DEFAULT_MAX_SIDE)
+    parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--output-dir', help='also write the shrunk images here')
+    args = parser.parse_args(argv)
+
+    preprocessor = Preprocessor(args.max_side, args.quality, args.processes)
+    for ref in preprocessor.prepare(list_images(args.source)):
+        if args.output_dir and 'Bytes' in ref:
+            target = os.path.join(args.output_dir, os.path.relpath(ref['path'], args.source))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(os.path.splitext(target)[0] + '.jpeg', 'wb') as out:
+                out.write(ref['Bytes'])
+    print(json.dumps(preprocessor.report(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Database helpers for the book catalog ingest.
+#
+# The lab resolves every author and theme with its own
+# `SELECT id FROM authors WHERE name = "..."` before deciding whether to
+# insert it. `NameIdCache` keeps the name -> id mapping of a lookup table in
+# memory so a name only reaches MySQL the first time it is seen, and
+# `BulkWriter` buffers books and writes them with `executemany`, committing
+# once per batch instead of once per book.
+#
+# The lab drops and rebuilds `book_catalog` on every run. `books_sync`
+# records a content hash and fetch time per ISBN, which lets the writer run
+# in incremental mode: unchanged books are skipped and changed ones are
+# upserted, so a nightly refresh only touches the delta.
+#
+# Long runs are checkpointed in `ingest_runs`: every batch commit also
+# bumps its run's progress row in the same transaction, and since
+# `books_sync` stamps each written ISBN, a resumed run can skip exactly the
+# ISBNs committed since the run started.
+#
+# Everything here takes a `dialect` of 'mysql' (the lab's RDS database) or
+# 'sqlite', so the ingest can be exercised against a local SQLite file.
+
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from isbn_source import normalize_isbn
+
+PLACEHOLDERS = {
+    'mysql': '%s',
+    'sqlite': '?',
+}
+
+SCHEMA = {
+    'mysql': [
+        '''
+        CREATE TABLE IF NOT EXISTS books (
+            isbn VARCHAR(13) PRIMARY KEY,
+            title TEXT NOT NULL,
+            subtitle TEXT DEFAULT NULL,
+            no_pages INT DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS authors (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            name TEXT NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS themes(
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            name TEXT NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS authors_books (
+            isbn VARCHAR(13),
+            author_id INT,
+            PRIMARY KEY (isbn, author_id),
+            FOREIGN KEY (isbn) REFERENCES books(isbn),
+            FOREIGN KEY (author_id) REFERENCES authors(id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS books_themes (
+            isbn VARCHAR(13),
+            theme_id INT,
+            PRIMARY KEY (isbn, theme_id),
+            FOREIGN KEY (isbn) REFERENCES books(isbn),
+            FOREIGN KEY (theme_id) REFERENCES themes(id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS books_sync (
+            isbn VARCHAR(13) PRIMARY KEY,
+            content_hash CHAR(40) DEFAULT NULL,
+            fetched_at DATETIME NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ingest_runs (
+            name VARCHAR(64) PRIMARY KEY,
+            started_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL,
+            batches INT DEFAULT 0,
+            books INT DEFAULT 0,
+            finished INT DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        ''',
+    ],
+    'sqlite': [
+        '''
+        CREATE TABLE IF NOT EXISTS books (
+            isbn VARCHAR(13) PRIMARY KEY,
+            title TEXT NOT NULL,
+            subtitle TEXT DEFAULT NULL,
+            no_pages INT DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS authors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS themes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS authors_books (
+            isbn VARCHAR(13) REFERENCES books(isbn),
+            author_id INT REFERENCES authors(id),
+            PRIMARY KEY (isbn, author_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS books_themes (
+            isbn VARCHAR(13) REFERENCES books(isbn),
+            theme_id INT REFERENCES themes(id),
+            PRIMARY KEY (isbn, theme_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS books_sync (
+            isbn VARCHAR(13) PRIMARY KEY,
+            content_hash CHAR(40) DEFAULT NULL,
+            fetched_at DATETIME NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ingest_runs (
+            name VARCHAR(64) PRIMARY KEY,
+            started_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL,
+            batches INT DEFAULT 0,
+            books INT DEFAULT 0,
+            finished INT DEFAULT 0
+        )
+        ''',
+    ],
+}
+
+# drop order respects the foreign keys between the tables
+TABLES = ['ingest_runs', 'books_sync', 'books_themes', 'authors_books', 'themes', 'authors', 'books']
+
+# `INSERT ... ON DUPLICATE KEY UPDATE` and its SQLite spelling
+UPSERT_BOOK = {
+    'mysql': '''
+        INSERT INTO books(isbn, title, subtitle, no_pages) VALUES(%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            title = VALUES(title), subtitle = VALUES(subtitle), no_pages = VALUES(no_pages)
+    ''',
+    'sqlite': '''
+        INSERT INTO books(isbn, title, subtitle, no_pages) VALUES(?, ?, ?, ?)
+        ON CONFLICT(isbn) DO UPDATE SET
+            title = excluded.title, subtitle = excluded.subtitle, no_pages = excluded.no_pages
+    ''',
+}
+
+UPSERT_SYNC = {
+    'mysql': '''
+        INSERT INTO books_sync(isbn, content_hash, fetched_at) VALUES(%s, %s, %s)
+        ON DUPLICATE KEY UPDATE content_hash = VALUES(content_hash), fetched_at = VALUES(fetched_at)
+    ''',
+    'sqlite': '''
+        INSERT INTO books_sync(isbn, content_hash, fetched_at) VALUES(?, ?, ?)
+        ON CONFLICT(isbn) DO UPDATE SET content_hash = excluded.content_hash, fetched_at = excluded.fetched_at
+    ''',
+}
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# upper bound on parameters sent in one `WHERE ... IN (...)` query
+IN_CHUNK_SIZE = 500
+
+
+def create_schema(db, dialect='mysql', reset=False):
+    """Create the catalog tables, dropping existing ones first if `reset` is set."""
+    cursor = db.cursor()
+    if reset:
+        for table in TABLES:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for stmt in SCHEMA[dialect]:
+        cursor.execute(stmt)
+    db.commit()
+    cursor.close()
+
+
+def utc_timestamp(moment=None):
+    """Format `moment` (default: now) as a UTC DATETIME literal."""
+    return (moment or datetime.now(timezone.utc)).strftime(TIMESTAMP_FORMAT)
+
+
+def content_hash(record):
+    """Return a stable SHA-1 of a parsed book record."""
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def stale_isbns(db, isbns, max_age, dialect='mysql', chunk_size=IN_CHUNK_SIZE):
+    """Yield the ISBNs not fetched within `max_age` (a timedelta).
+
+    Works through `isbns` in chunks so it can filter an input stream
+    before any of it reaches the fetcher.
+    """
+    cutoff = utc_timestamp(datetime.now(timezone.utc) - max_age)
+    return isbns_not_synced_since(db, isbns, cutoff, dialect, chunk_size)
+
+
+def isbns_not_synced_since(db, isbns, cutoff, dialect='mysql', chunk_size=IN_CHUNK_SIZE):
+    """Yield the ISBNs with no `books_sync` entry at or after `cutoff` (a DATETIME literal)."""
+    placeholder = PLACEHOLDERS[dialect]
+    cursor = db.cursor()
+    chunk = []
+    for isbn in isbns:
+        chunk.append(isbn)
+        if len(chunk) >= chunk_size:
+            yield from _stale_in_chunk(cursor, chunk, cutoff, placeholder)
+            chunk = []
+    if chunk:
+        yield from _stale_in_chunk(cursor, chunk, cutoff, placeholder)
+    cursor.close()
+
+
+def _stale_in_chunk(cursor, chunk, cutoff, placeholder):
+    markers = ', '.join([placeholder] * len(chunk))
+    select_fresh_stmt = 'SELECT isbn FROM books_sync WHERE fetched_at >= {} AND isbn IN ({})'.format(placeholder, markers)
+    cursor.execute(select_fresh_stmt, [cutoff] + [normalize_isbn(isbn) for isbn in chunk])
+    fresh = {row[0] for row in cursor.fetchall()}
+    return [isbn for isbn in chunk if normalize_isbn(isbn) not in fresh]
+
+
+def chunked(items, size):
+    """Yield successive lists of at most `size` items."""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class NameIdCache:
+    """Bounded LRU name -> id cache in front of the `authors` or `themes` table.
+
+    `placeholder` is the DB-API parameter marker of the driver in use
+    ('%s' for mysql.connector, '?' for sqlite3).
+    """
+
+    def __init__(self, db, table, max_size=100000, placeholder='%s'):
+        self.db = db
+        self.table = table
+        self.max_size = max_size
+        self.placeholder = placeholder
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Forget all cached ids, e.g. after a rollback discarded new rows."""
+        self.ids.clear()
+
+    def warm(self):
+        """Preload up to `max_size` existing names with a single query."""
+        cursor = self.db.cursor()
+        cursor.execute('SELECT id, name FROM {} ORDER BY id LIMIT {}'.format(self.table, self.max_size))
+        for row_id, name in cursor:
+            # keep the first id of a name, as the lab's SELECT ... fetchone would
+            self.ids.setdefault(name, row_id)
+        cursor.close()
+
+    def _remember(self, name, row_id):
+        self.ids[name] = row_id
+        self.ids.move_to_end(name)
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def _select_ids(self, cursor, names):
+        found = {}
+        for chunk in chunked(names, IN_CHUNK_SIZE):
+            markers = ', '.join([self.placeholder] * len(chunk))
+            cursor.execute('SELECT id, name FROM {} WHERE name IN ({})'.format(self.table, markers), chunk)
+            for row_id, name in cursor.fetchall():
+                found.setdefault(name, row_id)
+        return found
+
+    def resolve_many(self, names, cursor):
+        """Return a dict of name -> id for `names`, inserting the missing ones in bulk.
+
+        Ids of new rows are read back with a SELECT rather than derived from
+        `lastrowid`, which only reports the first id of a multi-row INSERT.
+        """
+        ids = {}
+        missing = []
+        for name in dict.fromkeys(names):
+            if name in self.ids:
+                self.hits += 1
+                self.ids.move_to_end(name)
+                ids[name] = self.ids[name]
+            else:
+                self.misses += 1
+                missing.append(name)
+
+        if missing:
+            ids.update(self._select_ids(cursor, missing))
+            new_names = [name for name in missing if name not in ids]
+            if new_names:
+                insert_stmt = 'INSERT INTO {}(name) VALUES({})'.format(self.table, self.placeholder)
+                cursor.executemany(insert_stmt, [(name,) for name in new_names])
+                ids.update(self._select_ids(cursor, new_names))
+            for name in missing:
+                self._remember(name, ids[name])
+        return ids
+
+
+class IngestRun:
+    """Progress row of a named ingest run in `ingest_runs`.
+
+    `start` registers a new run, or with `resume=True` picks up the
+    unfinished run of the same name and keeps its start time. The writer
+    calls `record_batch` inside each batch transaction, so the row always
+    matches what has been committed.
+    """
+
+    def __init__(self, db, name, dialect='mysql'):
+        self.db = db
+        self.name = name
+        self.dialect = dialect
+        self.placeholder = PLACEHOLDERS[dialect]
+        self.started_at = None
+        self.batches = 0
+        self.books = 0
+        self.resumed = False
+
+    def start(self, resume=False):
+        ph = self.placeholder
+        cursor = self.db.cursor()
+        cursor.execute('SELECT started_at, batches, books, finished FROM ingest_runs WHERE name = {}'.format(ph),
+                       (self.name,))
+        row = cursor.fetchone()
+        if resume and row is not None and not row[3]:
+            started_at, self.batches, self.books, _ = row
+            # mysql.connector hands back a datetime, sqlite3 the stored string
+            self.started_at = started_at if isinstance(started_at, str) else utc_timestamp(started_at)
+            self.resumed = True
+        else:
+            self.started_at = utc_timestamp()
+            cursor.execute('DELETE FROM ingest_runs WHERE name = {}'.format(ph), (self.name,))
+            cursor.execute('INSERT INTO ingest_runs(name, started_at, updated_at) VALUES({0}, {0}, {0})'.format(ph),
+                           (self.name, self.started_at, self.started_at))
+        self.db.commit()
+        cursor.close()
+        return self
+
+    def pending_isbns(self, isbns, db=None):
+        """Yield the ISBNs of `isbns` not yet committed by this run.
+
+        Pass a separate connection as `db` when the filter runs on another
+        thread than the writer.
+        """
+        return isbns_not_synced_since(db or self.db, isbns, self.started_at, self.dialect)
+
+    def record_batch(self, cursor, books):
+        """Count a batch of `books` ISBNs; runs inside the batch transaction."""
+        cursor.execute('UPDATE ingest_runs SET updated_at = {0}, batches = batches + 1, books = books + {0} '
+                       'WHERE name = {0}'.format(self.placeholder), (utc_timestamp(), books, self.name))
+        self.batches += 1
+        self.books += books
+
+    def finish(self):
+        cursor = self.db.cursor()
+        cursor.execute('UPDATE ingest_runs SET updated_at = {0}, finished = 1 WHERE name = {0}'.format(self.placeholder),
+                       (utc_timestamp(), self.name))
+        self.db.commit()
+        cursor.close()
+
+
+class BulkWriter:
+    """Buffer parsed books and write them to the catalog in batches.
+
+    `add` takes a cleaned ISBN and a record as returned by
+    `openlibrary.parse_book`, or None for an ISBN Open Library does not
+    know. Once `batch_size` books are buffered they are written with one
+    `executemany` per table and a single commit. Use the writer as a context
+    manager, or call `flush` at the end, so the last partial batch is
+    written too.
+
+    With `incremental=True` books whose content hash matches `books_sync`
+    are left alone, and changed or new books are upserted with their
+    author/theme links replaced. Otherwise plain INSERTs are used, as in
+    the lab, and a repeated ISBN is an error.
+
+    If an `IngestRun` is given its checkpoint is advanced in every batch
+    transaction.
+    """
+
+    def __init__(self, db, batch_size=500, dialect='mysql', author_cache=None, theme_cache=None,
+                 incremental=False, run=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.dialect = dialect
+        self.placeholder = PLACEHOLDERS[dialect]
+        self.incremental = incremental
+        self.run = run
+        self.authors = author_cache
+        self.themes = theme_cache
+        # caches built here start from the names already stored, so known names cost no round-trip
+        if self.authors is None:
+            self.authors = NameIdCache(db, 'authors', placeholder=self.placeholder)
+            self.authors.warm()
+        if self.themes is None:
+            self.themes = NameIdCache(db, 'themes', placeholder=self.placeholder)
+            self.themes.warm()
+        self.pending = []
+        self.books_written = 0
+        self.books_unchanged = 0
+        self.books_missing = 0
+        self.batches_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, isbn, record):
+        self.pending.append((isbn, record))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered books in one transaction."""
+        if not self.pending:
+            return
+        cursor = self.db.cursor()
+        try:
+            written, missing = self._write(cursor, self.pending)
+            if self.run is not None:
+                self.run.record_batch(cursor, len(self.pending))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            # ids handed out inside the failed transaction no longer exist
+            self.authors.clear()
+            self.themes.clear()
+            raise
+        finally:
+            cursor.close()
+        self.books_written += written
+        self.books_missing += missing
+        self.books_unchanged += len(self.pending) - written - missing
+        self.batches_written += 1
+        self.pending = []
+
+    def _stored_hashes(self, cursor, isbns):
+        hashes = {}
+        for chunk in chunked(isbns, IN_CHUNK_SIZE):
+            markers = ', '.join([self.placeholder] * len(chunk))
+            cursor.execute('SELECT isbn, content_hash FROM books_sync WHERE isbn IN ({})'.format(markers), chunk)
+            hashes.update(cursor.fetchall())
+        return hashes
+
+    def _write(self, cursor, pending):
+        ph = self.placeholder
+        fetched_at = utc_timestamp()
+        # the last record of an ISBN repeated within the batch wins
+        hashes = {isbn: (record, content_hash(record) if record is not None else None)
+                  for isbn, record in pending}
+
+        if self.incremental:
+            stored = self._stored_hashes(cursor, list(hashes))
+            books = [(isbn, record) for isbn, (record, digest) in hashes.items()
+                     if record is not None and stored.get(isbn, '') != digest]
+        else:
+            books = [(isbn, record) for isbn, record in pending if record is not None]
+
+        author_ids = self.authors.resolve_many(
+            [name for _, record in books for name in record['authors']], cursor)
+        theme_ids = self.themes.resolve_many(
+            [name for _, record in books for name in record['themes']], cursor)
+
+        book_rows = [(isbn, r['title'], r['subtitle'], r['no_pages']) for isbn, r in books]
+        # a book listing the same author or subject twice would break the link tables' primary keys
+        author_rows = [(isbn, author_ids[name]) for isbn, r in books for name in dict.fromkeys(r['authors'])]
+        theme_rows = [(isbn, theme_ids[name]) for isbn, r in books for name in dict.fromkeys(r['themes'])]
+
+        if self.incremental:
+            cursor.executemany(UPSERT_BOOK[self.dialect], book_rows)
+            # changed books get their links rebuilt from scratch
+            for chunk in chunked([isbn for isbn, _ in books], IN_CHUNK_SIZE):
+                markers = ', '.join([ph] * len(chunk))
+                cursor.execute('DELETE FROM authors_books WHERE isbn IN ({})'.format(markers), chunk)
+                cursor.execute('DELETE FROM books_themes WHERE isbn IN ({})'.format(markers), chunk)
+        elif book_rows:
+            insert_book_stmt = 'INSERT INTO books(isbn, title, subtitle, no_pages) VALUES({0}, {0}, {0}, {0})'.format(ph)
+            cursor.executemany(insert_book_stmt, book_rows)
+        if author_rows:
+            cursor.executemany('INSERT INTO authors_books VALUES ({0}, {0})'.format(ph), author_rows)
+        if theme_rows:
+            cursor.executemany('INSERT INTO books_themes VALUES ({0}, {0})'.format(ph), theme_rows)
+
+        sync_rows = [(isbn, digest, fetched_at) for isbn, (_, digest) in hashes.items()]
+        cursor.executemany(UPSERT_SYNC[self.dialect], sync_rows)
+        missing = sum(1 for _, record in pending if record is None)
+        return len(books), missing
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Throughput benchmark for the book catalog ingest.
+#
+# Runs `ingest_pipeline.run_pipeline` end to end without touching Open
+# Library or RDS: a local HTTP server answers `api/books` requests with
+# synthetic books after a configurable delay, and the catalog is written
+# to a throwaway SQLite file whose connection counts every statement and
+# commit sent to it. For each input size the report gives books/sec,
+# p50/p99 latency of the fetch, parse and write stages, and DB round trips
+# per book. Results can be appended to a JSONL file to track regressions.
+#
+# Usage:
+#     python ingest_benchmark.py --sizes 1000 10000 100000 --latency-ms 50
+#     python ingest_benchmark.py --sizes 1000000 --output bench.jsonl
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import catalog_db
+import ingest_pipeline
+
+
+def synthetic_isbns(count, start=0):
+    """Yield `count` distinct, checksum-valid ISBN-13s."""
+    for n in range(start, start + count):
+        body = '978%09d' % n
+        total = sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(body))
+        yield body + str((10 - total % 10) % 10)
+
+
+class _FakeBooksHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlparse(self.path)
+        if url.path != '/api/books':
+            self.send_error(404)
+            return
+        bibkeys = parse_qs(url.query).get('bibkeys', [''])[0].split(',')
+        delay = config['latency'] + random.uniform(0, config['jitter'])
+        if delay > 0:
+            time.sleep(delay)
+        body = json.dumps({key: self.server.book(key) for key in bibkeys
+                           if self.server.known(key)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOpenLibrary(ThreadingHTTPServer):
+    """Local stand-in for the `api/books` endpoint.
+
+    Every request waits `latency` seconds plus up to `jitter` more. Books
+    are built from the ISBN so runs are repeatable: authors and subjects are
+    drawn from fixed pools and the description is padded to about
+    `payload_bytes`. A `missing_ratio` share of ISBNs is reported unknown.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, jitter=0.0, payload_bytes=2000, authors=5000, subjects=500,
+                 missing_ratio=0.02, port=0):
+        super().__init__(('127.0.0.1', port), _FakeBooksHandler)
+        self.config = {'latency': latency, 'jitter': jitter}
+        self.payload_bytes = payload_bytes
+        self.authors = authors
+        self.subjects = subjects
+        self.missing_ratio = missing_ratio
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:%d/api/books' % self.server_port
+
+    def known(self, key):
+        return (zlib.crc32(key.encode('utf-8')) % 10000) / 10000 >= self.missing_ratio
+
+    def book(self, key):
+        seed = int(''.join(c for c in key if c.isdigit()) or 0)
+        book = {
+            'title': 'Book %s' % key,
+            'subtitle': 'Subtitle %d' % (seed % 97),
+            'number_of_pages': 50 + seed % 900,
+            'authors': [{'name': 'Author %d' % ((seed * 7 + i) % self.authors)} for i in range(1 + seed % 3)],
+            'subjects': [{'name': 'Subject %d' % ((seed * 13 + i) % self.subjects)} for i in range(seed % 6)],
+        }
+        padding = self.payload_bytes - len(json.dumps(book))
+        if padding > 0:
+            book['notes'] = 'x' * padding
+        return book
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args):
+        self._counter['statements'] += 1
+        return self._cursor.execute(*args)
+
+    def executemany(self, *args):
+        self._counter['statements'] += 1
+        return self._cursor.executemany(*args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection:
+    """DB-API connection wrapper counting the round trips sent to the database.
+
+    Each `execute`, `executemany` and `commit` counts as one round trip,
+    which is what they cost against a remote MySQL server.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.counter = {'statements': 0, 'commits': 0}
+
+    @property
+    def round_trips(self):
+        return self.counter['statements'] + self.counter['commits']
+
+    def cursor(self):
+        return _CountingCursor(self._db.cursor(), self.counter)
+
+    def commit(self):
+        self.counter['commits'] += 1
+        self._db.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def run_benchmark(size, server, workdir, fetch_workers=8, parse_workers=2, queue_size=64,
+                  write_batch_size=500, batch=True):
+    """Ingest `size` synthetic ISBNs into a fresh SQLite catalog; return the report."""
+    path = os.path.join(workdir, 'catalog-%d.db' % size)
+    if os.path.exists(path):
+        os.remove(path)
+    raw = sqlite3.connect(path, check_same_thread=False)
+    catalog_db.create_schema(raw, 'sqlite')
+    db = CountingConnection(raw)
+    requests_before = server.requests
+    try:
+        stats = ingest_pipeline.run_pipeline(synthetic_isbns(size), db, 'sqlite',
+                                             fetch_workers=fetch_workers,
+                                             parse_workers=parse_workers,
+                                             queue_size=queue_size,
+                                             batch=batch,
+                                             write_batch_size=write_batch_size,
+                                             api_url=server.api_url)
+    finally:
+        raw.close()
+    return {
+        'books': size,
+        'seconds': round(stats['seconds'], 3),
+        'books_per_sec': round(size / stats['seconds'], 1) if stats['seconds'] else None,
+        'http_requests': server.requests - requests_before,
+        'db_round_trips': db.round_trips,
+        'db_round_trips_per_book': round(db.round_trips / size, 4) if size else None,
+        'stage_latency_ms': {stage: {point: round(value * 1000, 3) if value is not None else None
+                                     for point, value in points.items()}
+                             for stage, points in stats['latency'].items()},
+        'books_written': stats['books_written'],
+        'books_missing': stats['books_missing'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the book catalog ingest against local stand-ins.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='fake API delay per request')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='extra random delay per request')
+    parser.add_argument('--payload-bytes', type=int, default=2000, help='approximate JSON size per book')
+    parser.add_argument('--missing-ratio', type=float, default=0.02, help='share of ISBNs reported unknown')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--parse-workers', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=64)
+    parser.add_argument('--write-batch-size', type=int, default=500)
+    parser.add_argument('--no-batch', action='store_true', help='send one ISBN per request')
+    parser.add_argument('--output', metavar='PATH', help='append one JSON line per run to this file')
+    args = parser.parse_args(argv)
+
+    settings = {
+        'api_latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms,
+        'payload_bytes': args.payload_bytes,
+        'fetch_workers': args.fetch_workers,
+        'parse_workers': args.parse_workers,
+        'queue_size': args.queue_size,
+        'write_batch_size': args.write_batch_size,
+        'batch': not args.no_batch,
+    }
+    workdir = tempfile.mkdtemp(prefix='ingest-bench-')
+    server = FakeOpenLibrary(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                             payload_bytes=args.payload_bytes, missing_ratio=args.missing_ratio)
+    try:
+        with server:
+            for size in args.sizes:
+                report = run_benchmark(size, server, workdir,
+                                       fetch_workers=args.fetch_workers,
+                                       parse_workers=args.parse_workers,
+                                       queue_size=args.queue_size,
+                                       write_batch_size=args.write_batch_size,
+                                       batch=not args.no_batch)
+                report.update(settings)
+                report['timestamp'] = catalog_db.utc_timestamp()
+                print(json.dumps(report))
+                if args.output:
+                    with open(args.output, 'a') as out:
+                        out.write(json.dumps(report) + '\n')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
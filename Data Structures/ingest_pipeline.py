@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Streaming ingest of the book catalog.
+#
+# The lab fetches, parses and stores one book at a time, so MySQL idles
+# while the API answers and the other way round. Here the ingest is split
+# into stages connected by bounded queues:
+#
+#     ISBN source -> fetchers -> parsers -> batched DB sink
+#
+# Each stage runs its own worker threads. When a downstream stage falls
+# behind its queue fills up and the upstream stage blocks, so memory stays
+# bounded and throughput is set by the slowest stage.
+#
+# Usage:
+#     python ingest_pipeline.py isbns.txt --sqlite catalog.db
+#     python ingest_pipeline.py isbns.txt            # the lab's RDS instance
+#     zcat dump.jsonl.gz | python ingest_pipeline.py - --input-format jsonl
+#     python ingest_pipeline.py isbns.txt --run nightly --resume
+#     python ingest_pipeline.py isbns.txt --incremental --max-age 7
+#
+# Every batch commit also advances the run's checkpoint in `ingest_runs`.
+# After a crash, `--resume` restarts the same named run and skips the
+# ISBNs it already committed, before they reach the fetchers.
+#
+# The catalog tables are kept between runs, so unless `--reset` empties
+# them first the ingest is incremental: unchanged books are skipped and
+# changed ones upserted, instead of failing on the first stored ISBN.
+
+import argparse
+import queue
+from array import array
+from datetime import timedelta
+import threading
+import time
+
+import catalog_db
+import openlibrary
+from isbn_source import IsbnSource, normalize_isbn
+
+# ISBNs used by the lab when no input file is given
+ISBN_LIST = [
+    '978-0201853926',
+    '0201558025',
+    '978-1-93435-645-6',
+    '9780199218462',
+    '978-4915512377',
+    '1593278551',
+    '0811862151',
+    '9780761174707',
+    '1844834115',
+    '9781408845646',
+    '9780201896831',
+    '0321534964',
+    '1408855895',
+    '0590353403',
+]
+
+_DONE = object()
+
+
+class PipelineError(Exception):
+    """Raised in the calling thread when a pipeline worker failed."""
+
+
+class _Stage:
+    """A pool of worker threads reading from one queue and writing to the next.
+
+    `handle(item)` returns the list of items to pass downstream. A stage
+    without an inbox is a source: `handle()` is called once and everything
+    it yields is passed downstream. When the last worker of a stage sees
+    the end of its input it tells each worker of the next stage to stop.
+    The duration of every `handle(item)` call is kept in `latencies`.
+    """
+
+    def __init__(self, name, workers, handle, inbox, outbox, downstream_workers, stop):
+        self.name = name
+        self.handle = handle
+        self.inbox = inbox
+        self.outbox = outbox
+        self.downstream_workers = downstream_workers
+        self.stop = stop
+        self.processed = 0
+        self.latencies = array('d')
+        self.error = None
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name='%s-%d' % (name, i), daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        try:
+            if self.inbox is None:
+                self._feed()
+                return
+            while not self.stop.is_set():
+                item = _get(self.inbox, self.stop)
+                if item is _DONE or item is None:
+                    break
+                began = time.perf_counter()
+                results = self.handle(item)
+                elapsed = time.perf_counter() - began
+                for result in results:
+                    _put(self.outbox, result, self.stop)
+                with self.lock:
+                    self.processed += 1
+                    self.latencies.append(elapsed)
+        except Exception as error:
+            self.error = error
+            self.stop.set()
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last:
+                for _ in range(self.downstream_workers):
+                    _put(self.outbox, _DONE, self.stop)
+
+    def _feed(self):
+        for item in self.handle():
+            if self.stop.is_set():
+                break
+            _put(self.outbox, item, self.stop)
+            self.processed += 1
+
+
+def _put(q, item, stop):
+    # poll so a failure elsewhere can't leave us blocked on a full queue
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def percentiles(samples, points=(50, 99)):
+    """Return a dict of 'p<n>' -> nearest-rank percentile of `samples` (None if empty)."""
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        if ordered:
+            rank = max(0, min(len(ordered) - 1, int(round(point / 100 * len(ordered))) - 1))
+            result['p%d' % point] = ordered[rank]
+        else:
+            result['p%d' % point] = None
+    return result
+
+
+def run_pipeline(isbns, db, dialect='mysql', fetch_workers=8, parse_workers=2, queue_size=64,
+                 batch=True, write_batch_size=500, incremental=False, cache=None,
+                 api_url=openlibrary.API_URL, timeout=30, run=None):
+    """Ingest `isbns` into `db` and return a dict of counters.
+
+    `isbns` may be any iterable, including a lazy stream, of ISBNs
+    normalized as `isbn_source.normalize_isbn` does. Fetching and
+    parsing run on worker threads; the DB writes happen on the calling
+    thread, which owns the connection. A started `catalog_db.IngestRun`
+    is checkpointed with every batch and marked finished at the end.
+    """
+    stop = threading.Event()
+    session = openlibrary.make_session(fetch_workers)
+    fetch_q = queue.Queue(queue_size)
+    parse_q = queue.Queue(queue_size)
+    write_q = queue.Queue(queue_size)
+    # HTTP requests actually sent; batches answered entirely from the cache don't count
+    requests = [0]
+    requests_lock = threading.Lock()
+
+    def read_source():
+        if batch:
+            return openlibrary.batch_isbns(isbns, api_url)
+        return ([isbn] for isbn in isbns)
+
+    def fetch(isbn_batch):
+        books, requested = openlibrary.fetch_with_cache(session, isbn_batch, cache, api_url, timeout)
+        if requested:
+            with requests_lock:
+                requests[0] += 1
+        return [[(isbn, books[isbn]) for isbn in isbn_batch]]
+
+    def parse(pairs):
+        # the ISBNs arrive normalized, so an ISBN-10 check digit of X is kept
+        return [[(isbn, openlibrary.parse_book(book) if book is not None else None) for isbn, book in pairs]]
+
+    stages = [
+        _Stage('source', 1, read_source, None, fetch_q, fetch_workers, stop),
+        _Stage('fetch', fetch_workers, fetch, fetch_q, parse_q, parse_workers, stop),
+        _Stage('parse', parse_workers, parse, parse_q, write_q, 1, stop),
+    ]
+
+    started = time.perf_counter()
+    writer = catalog_db.BulkWriter(db, write_batch_size, dialect, incremental=incremental, run=run)
+    write_latencies = array('d')
+    for stage in stages:
+        stage.start()
+    try:
+        while True:
+            records = _get(write_q, stop)
+            if records is _DONE or records is None:
+                break
+            began = time.perf_counter()
+            for isbn, record in records:
+                writer.add(isbn, record)
+            write_latencies.append(time.perf_counter() - began)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for stage in stages:
+            for thread in stage.threads:
+                thread.join()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise PipelineError('%s stage failed' % stage.name) from stage.error
+    writer.flush()
+    if run is not None:
+        run.finish()
+
+    return {
+        'books_written': writer.books_written,
+        'books_unchanged': writer.books_unchanged,
+        'books_missing': writer.books_missing,
+        'batches_written': writer.batches_written,
+        'requests': requests[0],
+        'seconds': time.perf_counter() - started,
+        'latency': {
+            'fetch': percentiles(stages[1].latencies),
+            'parse': percentiles(stages[2].latencies),
+            'write': percentiles(write_latencies),
+        },
+    }
+
+
+def connect_rds():
+    """Connect to the lab's RDS instance and select the `book_catalog` database."""
+    import boto3
+    import mysql.connector
+
+    rds_client = boto3.client('rds')
+    response = rds_client.describe_db_instances()
+    endpoint = response['DBInstances'][0]['Endpoint']['Address']
+
+    db = mysql.connector.connect(
+        host=endpoint,
+        user='admin',
+        passwd='demotest123'
+    )
+    cursor = db.cursor()
+    cursor.execute('CREATE DATABASE IF NOT EXISTS book_catalog')
+    cursor.execute('USE book_catalog')
+    cursor.close()
+    return db
+
+
+def connect(sqlite_path=None):
+    """Return `(db, dialect)` for a local SQLite file or the lab's RDS instance."""
+    if sqlite_path:
+        import sqlite3
+        return sqlite3.connect(sqlite_path, check_same_thread=False), 'sqlite'
+    return connect_rds(), 'mysql'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest Open Library books into the book catalog.')
+    parser.add_argument('input', nargs='?',
+                        help="text/CSV/JSONL file of ISBNs, or '-' for stdin (default: the lab ISBNs)")
+    parser.add_argument('--input-format', choices=['text', 'csv', 'jsonl'])
+    parser.add_argument('--isbn-field', default='isbn', help='CSV column or JSON key holding the ISBN')
+    parser.add_argument('--sqlite', metavar='PATH', help='write to a local SQLite file instead of RDS')
+    parser.add_argument('--reset', action='store_true', help='drop and recreate the catalog tables first')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip unchanged books, upsert changed ones (the default unless --reset is given)')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--parse-workers', type=int, default=2)
+    parser.add_argument('--queue-size', type=int, default=64)
+    parser.add_argument('--write-batch-size', type=int, default=500)
+    parser.add_argument('--no-batch', action='store_true', help='send one ISBN per request')
+    parser.add_argument('--cache', metavar='PATH', help='SQLite response cache file')
+    parser.add_argument('--api-url', default=openlibrary.API_URL)
+    parser.add_argument('--run', default='default', help='name of the run to checkpoint')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the unfinished run of this name, skipping committed ISBNs')
+    parser.add_argument('--max-age', type=float, metavar='DAYS',
+                        help='skip ISBNs synced within this many days (not with --reset)')
+    args = parser.parse_args(argv)
+    if args.resume and args.reset:
+        parser.error('--resume cannot be combined with --reset')
+    # the tables are kept between runs, so plain INSERTs are only safe right after --reset
+    incremental = args.incremental or not args.reset
+    if args.max_age is not None and not incremental:
+        parser.error('--max-age needs --incremental when combined with --reset')
+
+    db, dialect = connect(args.sqlite)
+    catalog_db.create_schema(db, dialect, reset=args.reset)
+    run = catalog_db.IngestRun(db, args.run, dialect).start(resume=args.resume)
+
+    cache = None
+    if args.cache:
+        from response_cache import ResponseCache
+        cache = ResponseCache(args.cache)
+
+    source = None
+    if args.input:
+        source = IsbnSource(args.input, args.input_format, args.isbn_field)
+        isbns = source
+    else:
+        isbns = [normalize_isbn(isbn) for isbn in ISBN_LIST]
+
+    filter_db = None
+    if run.resumed or args.max_age is not None:
+        # the filters run on the source thread, so they get their own connection
+        filter_db, _ = connect(args.sqlite)
+    if run.resumed:
+        isbns = run.pending_isbns(isbns, filter_db)
+    if args.max_age is not None:
+        isbns = catalog_db.stale_isbns(filter_db, isbns, timedelta(days=args.max_age), dialect)
+
+    stats = run_pipeline(isbns, db, dialect,
+                         fetch_workers=args.fetch_workers,
+                         parse_workers=args.parse_workers,
+                         queue_size=args.queue_size,
+                         batch=not args.no_batch,
+                         write_batch_size=args.write_batch_size,
+                         incremental=incremental,
+                         cache=cache,
+                         api_url=args.api_url,
+                         run=run)
+    stats['run'] = {'name': run.name, 'resumed': run.resumed, 'batches': run.batches, 'books': run.books}
+    if cache is not None:
+        stats['cache'] = cache.stats()
+    if source is not None:
+        stats['input'] = source.stats()
+    print(stats)
+    if filter_db is not None:
+        filter_db.close()
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Streaming ISBN input for the book catalog ingest.
+#
+# The lab keeps its ISBNs in a literal `isbn_list`. Real inputs are dumps
+# of millions of lines, so `read_isbns` streams them from a text, CSV or
+# JSONL file (optionally gzipped) or from stdin, one line at a time. Each
+# ISBN is normalized the way the lab does it, checked against its ISBN-10
+# or ISBN-13 check digit, and dropped if it was already seen. Duplicates
+# are tracked with a fixed-size Bloom filter and a bounded window of the
+# most recent ISBNs, so memory use does not grow with the input. A Bloom
+# hit is only dropped when the window confirms it; otherwise it may be a
+# false positive, so it is passed on and counted as a probable duplicate,
+# and a real repeat is absorbed by the incremental writer downstream.
+#
+# Usage:
+#     python isbn_source.py dump.jsonl --field isbn > isbns.txt
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import sys
+
+
+def normalize_isbn(isbn):
+    """Apply the lab's `re.sub('[^0-9]', '', isbn)`, keeping an ISBN-10 check digit of X.
+
+    This is the form stored in `books.isbn` and used as the response cache
+    key, so every module normalizes with this one function.
+    """
+    isbn = isbn.strip().upper()
+    digits = re.sub('[^0-9]', '', isbn)
+    if len(digits) == 9 and isbn.endswith('X'):
+        return digits + 'X'
+    return digits
+
+
+def is_valid_isbn10(isbn):
+    if not re.fullmatch('[0-9]{9}[0-9X]', isbn):
+        return False
+    total = sum((10 - i) * int(c) for i, c in enumerate(isbn[:9]))
+    total += 10 if isbn[9] == 'X' else int(isbn[9])
+    return total % 11 == 0
+
+
+def is_valid_isbn13(isbn):
+    if not re.fullmatch('[0-9]{13}', isbn):
+        return False
+    total = sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(isbn))
+    return total % 10 == 0
+
+
+def is_valid_isbn(isbn):
+    """Check the length and check digit of a normalized ISBN-10 or ISBN-13."""
+    if len(isbn) == 10:
+        return is_valid_isbn10(isbn)
+    if len(isbn) == 13:
+        return is_valid_isbn13(isbn)
+    return False
+
+
+class BloomFilter:
+    """Fixed-size set membership test with a bounded false positive rate.
+
+    Sized for `capacity` items at `error_rate`; `add` returns True if the
+    item was (probably) already present. The hashes are keyed with `seed`,
+    random unless given, so the false positives differ from run to run.
+    """
+
+    def __init__(self, capacity=10000000, error_rate=1e-4, seed=None):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.key = os.urandom(16) if seed is None else seed.to_bytes(16, 'little')
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16, key=self.key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        present = True
+        for pos in self._positions(item):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        return present
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+def detect_format(path):
+    """Guess 'text', 'csv' or 'jsonl' from a file name."""
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'text'
+
+
+def open_input(path):
+    """Open `path` for reading text; '-' is stdin and `.gz` files are decompressed."""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', errors='replace')
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace', newline='')
+
+
+def _raw_values(lines, fmt, field):
+    if fmt == 'text':
+        for line in lines:
+            yield line
+    elif fmt == 'csv':
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if header is None:
+            return
+        if field in header:
+            column = header.index(field)
+        else:
+            # no matching header: the first row is data
+            column = int(field) if field.isdigit() else 0
+            if column < len(header):
+                yield header[column]
+        for row in reader:
+            if column < len(row):
+                yield row[column]
+    elif fmt == 'jsonl':
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(value, dict):
+                value = value.get(field)
+            if isinstance(value, (str, int)):
+                yield str(value)
+    else:
+        raise ValueError('unknown input format: %r' % fmt)
+
+
+class IsbnSource:
+    """Iterable of normalized, valid, de-duplicated ISBNs read from `path`.
+
+    `fmt` is 'text', 'csv' or 'jsonl' (guessed from the file name if
+    omitted; stdin defaults to text). `field` is the CSV column or JSON key
+    holding the ISBN. Counters of what was read and dropped are kept on the
+    instance while it is being iterated.
+
+    An ISBN is dropped as a duplicate only if it is among the last
+    `window` ISBNs emitted. A Bloom filter hit on an older or unseen ISBN
+    is emitted and counted in `probable_duplicates`, since it may be a
+    false positive.
+    """
+
+    def __init__(self, path='-', fmt=None, field='isbn', validate=True, dedupe=True,
+                 capacity=10000000, error_rate=1e-4, window=250000):
+        self.path = path
+        self.fmt = fmt or ('text' if path == '-' else detect_format(path))
+        self.field = field
+        self.validate = validate
+        self.seen = BloomFilter(capacity, error_rate) if dedupe else None
+        # insertion-ordered, so the oldest entry is evicted first
+        self.recent = {}
+        self.window = window
+        self.read = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.probable_duplicates = 0
+        self.emitted = 0
+
+    def _remember(self, isbn):
+        self.recent[isbn] = None
+        if len(self.recent) > self.window:
+            del self.recent[next(iter(self.recent))]
+
+    def __iter__(self):
+        stream = open_input(self.path)
+        try:
+            for raw in _raw_values(stream, self.fmt, self.field):
+                isbn = normalize_isbn(raw)
+                if not isbn:
+                    continue
+                self.read += 1
+                if self.validate and not is_valid_isbn(isbn):
+                    self.invalid += 1
+                    continue
+                if self.seen is not None:
+                    if self.seen.add(isbn):
+                        if isbn in self.recent:
+                            self.duplicates += 1
+                            continue
+                        self.probable_duplicates += 1
+                    self._remember(isbn)
+                self.emitted += 1
+                yield isbn
+        finally:
+            if self.path == '-':
+                # leave the process's stdin open
+                stream.detach()
+            else:
+                stream.close()
+
+    def stats(self):
+        return {
+            'read': self.read,
+            'invalid': self.invalid,
+            'duplicates': self.duplicates,
+            'probable_duplicates': self.probable_duplicates,
+            'emitted': self.emitted,
+        }
+
+
+def read_isbns(path='-', fmt=None, field='isbn', validate=True, dedupe=True):
+    """Lazily yield cleaned ISBNs from a file or stdin; see `IsbnSource`."""
+    return iter(IsbnSource(path, fmt, field, validate, dedupe))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Normalize, validate and de-duplicate an ISBN list.')
+    parser.add_argument('input', nargs='?', default='-', help="input file, or '-' for stdin")
+    parser.add_argument('--format', choices=['text', 'csv', 'jsonl'])
+    parser.add_argument('--field', default='isbn', help='CSV column or JSON key holding the ISBN')
+    parser.add_argument('--no-validate', action='store_true')
+    args = parser.parse_args(argv)
+
+    source = IsbnSource(args.input, args.format, args.field, validate=not args.no_validate)
+    for isbn in source:
+        sys.stdout.write(isbn + '\n')
+    print(source.stats(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
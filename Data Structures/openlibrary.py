@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Fetch stage for the book catalog ingest.
+#
+# The lab's ingest loop sends one `requests.get` per ISBN on a fresh
+# connection and waits for each answer before asking for the next one.
+# The helpers below share a pooled `requests.Session` (keep-alive
+# connections are reused across lookups) and run lookups on a thread pool,
+# yielding every result next to the ISBN it was requested for.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = 'http://openlibrary.org/api/books'
+
+# keep request URLs under the length proxies and servers reliably accept
+MAX_URL_LENGTH = 2000
+
+
+def make_session(pool_size=10):
+    """Return a session keeping up to `pool_size` keep-alive connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def book_params(isbns):
+    """Return the `api/books` query parameters for one or more ISBNs."""
+    return {
+        'bibkeys': ','.join('ISBN:%s' % isbn for isbn in isbns),
+        'format': 'json',
+        'jscmd': 'data'
+    }
+
+
+def fetch_batch(session, isbns, api_url=API_URL, timeout=30):
+    """Look up several ISBNs in one request; return a dict of isbn -> book JSON or None."""
+    r = session.get(api_url, params=book_params(isbns), timeout=timeout)
+    r.raise_for_status()
+    data = r.json()
+    return {isbn: data.get('ISBN:%s' % isbn) for isbn in isbns}
+
+
+def fetch_book(session, isbn, api_url=API_URL, timeout=30):
+    """Look up a single ISBN; return the book JSON or None if it is unknown."""
+    return fetch_batch(session, [isbn], api_url, timeout)[isbn]
+
+
+def batch_isbns(isbns, api_url=API_URL, max_url_length=MAX_URL_LENGTH, max_batch_size=None):
+    """Group ISBNs into lists whose request URL stays within `max_url_length`.
+
+    The batch size adapts to the ISBNs themselves: each one adds its encoded
+    `ISBN:<isbn>` bibkey plus a separator to the query string.
+    """
+    base_length = len(api_url) + 1 + len(urlencode(book_params([])))
+    separator_length = len(quote(','))
+    batch, length = [], base_length
+    for isbn in isbns:
+        cost = len(quote('ISBN:%s' % isbn)) + (separator_length if batch else 0)
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or length + cost > max_url_length):
+            yield batch
+            batch, length = [], base_length
+            cost -= separator_length
+        batch.append(isbn)
+        length += cost
+    if batch:
+        yield batch
+
+
+def parse_book(book):
+    """Extract the fields stored by the lab from an Open Library book record."""
+    return {
+        'title': book['title'],
+        'subtitle': book['subtitle'] if 'subtitle' in book else '',
+        'no_pages': book['number_of_pages'] if 'number_of_pages' in book else 0,
+        'authors': [auth['name'] for auth in book.get('authors', [])],
+        'themes': [subj['name'] for subj in book['subjects']] if 'subjects' in book else [],
+    }
+
+
+def fetch_with_cache(session, isbns, cache=None, api_url=API_URL, timeout=30):
+    """Look up a batch of ISBNs, consulting `cache` first; return `(books, requested)`.
+
+    `books` maps every ISBN to its book JSON or None. Only the ISBNs the
+    `response_cache.ResponseCache` misses are fetched, in one request, and
+    stored in it; `requested` is whether that request was made.
+    """
+    books = {}
+    if cache is not None:
+        for isbn in isbns:
+            found, book = cache.get(isbn)
+            if found:
+                books[isbn] = book
+    misses = [isbn for isbn in isbns if isbn not in books]
+    if not misses:
+        return books, False
+    fetched = fetch_batch(session, misses, api_url, timeout)
+    if cache is not None:
+        cache.put_many(fetched)
+    books.update(fetched)
+    return books, True
+
+
+def fetch_books(isbns, max_workers=8, api_url=API_URL, session=None, timeout=30,
+                batch=False, max_url_length=MAX_URL_LENGTH, max_batch_size=None, cache=None):
+    """Fetch books concurrently, yielding `(isbn, book)` pairs in input order.
+
+    At most `max_workers` requests are in flight at once and only a small
+    window of results is held back to keep the input order, so `isbns` may
+    be an arbitrarily long iterator. With `batch=True` several ISBNs are
+    packed into each request (see `batch_isbns`) and the response is split
+    back out per book. If a `response_cache.ResponseCache` is given it is
+    consulted first and only its misses go to the network. `book` is None
+    for ISBNs Open Library does not know about.
+    """
+    if session is None:
+        session = make_session(max_workers)
+
+    if batch:
+        batches = batch_isbns(isbns, api_url, max_url_length, max_batch_size)
+    else:
+        batches = ([isbn] for isbn in isbns)
+
+    window = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for isbn_batch in batches:
+            window.append((isbn_batch, executor.submit(fetch_with_cache, session, isbn_batch, cache, api_url,
+                                                       timeout)))
+            # keep a couple of requests queued per worker, then hand back the oldest
+            if len(window) >= 2 * max_workers:
+                isbn_batch, future = window.popleft()
+                books, _ = future.result()
+                for isbn in isbn_batch:
+                    yield isbn, books[isbn]
+
+        while window:
+            isbn_batch, future = window.popleft()
+            books, _ = future.result()
+            for isbn in isbn_batch:
+                yield isbn, books[isbn]
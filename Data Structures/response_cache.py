@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persistent cache of Open Library book responses.
+#
+# Every run of the ingest downloads each book's JSON again. `ResponseCache`
+# keeps the responses in a local SQLite file, zlib-compressed and keyed by
+# the cleaned ISBN, so re-runs and restarted runs only go to the network for
+# books that are new or whose entry has expired. Unknown ISBNs are cached
+# too, so they are not asked for again on every run.
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from isbn_source import normalize_isbn
+
+DAY = 24 * 60 * 60
+
+
+class ResponseCache:
+    """SQLite-backed book response cache with a TTL and a size cap.
+
+    Entries older than `ttl` seconds count as misses. Once the stored
+    payloads grow past `max_bytes` the oldest entries are evicted.
+    """
+
+    def __init__(self, path, ttl=7 * DAY, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                isbn TEXT PRIMARY KEY,
+                fetched_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                payload BLOB NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_fetched_at ON responses(fetched_at)')
+        self.conn.commit()
+        self.total_bytes = self._stored_bytes()
+
+    def _stored_bytes(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, isbn):
+        """Return `(found, book)`; `book` is None for a cached unknown ISBN."""
+        with self.lock:
+            row = self.conn.execute('SELECT fetched_at, payload FROM responses WHERE isbn = ?',
+                                    (normalize_isbn(isbn),)).fetchone()
+            if row is None or row[0] < time.time() - self.ttl:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, json.loads(zlib.decompress(row[1]))
+
+    def put_many(self, books):
+        """Store a dict of isbn -> book JSON (or None) in one transaction."""
+        now = time.time()
+        rows = []
+        for isbn, book in books.items():
+            payload = zlib.compress(json.dumps(book).encode('utf-8'))
+            rows.append((normalize_isbn(isbn), now, len(payload), payload))
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', rows)
+            self.conn.commit()
+            # replaced entries make this an overestimate, which only triggers an exact recount
+            self.total_bytes += sum(row[2] for row in rows)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def put(self, isbn, book):
+        self.put_many({isbn: book})
+
+    def _evict(self):
+        self.total_bytes = self._stored_bytes()
+        # evict down to 90% of the cap so we don't evict again on the next put
+        excess = self.total_bytes - int(self.max_bytes * 0.9)
+        if excess <= 0:
+            return
+        oldest = self.conn.execute('SELECT isbn, size FROM responses ORDER BY fetched_at')
+        evicted, freed = [], 0
+        for isbn, size in oldest:
+            if freed >= excess:
+                break
+            evicted.append((isbn,))
+            freed += size
+        oldest.close()
+        self.conn.executemany('DELETE FROM responses WHERE isbn = ?', evicted)
+        self.conn.commit()
+        self.total_bytes -= freed
+
+    def stats(self):
+        with self.lock:
+            hits, misses, total_bytes = self.hits, self.misses, self.total_bytes
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'bytes': total_bytes,
+        }
+
+    def close(self):
+        self.conn.close()
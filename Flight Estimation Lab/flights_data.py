@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Chunked loader for the flight delay data.
+#
+# The lab reads all of `Flights.csv` with one `pd.read_csv(filepath,
+# dtype=dtypes)`, holding every integer and float column at 64 bits.
+# `read_flights` instead parses the file `chunksize` rows at a time, skips
+# the dropped columns while parsing, and casts each numeric column to the
+# narrow type in `COMPACT_DTYPES`, so a file of any size can be handled as
+# a stream of small frames. `load_flights` concatenates such a stream into
+# a single frame when it does fit in memory.
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# the lab's `dtypes`
+DTYPES = {
+    "YEAR": np.int64,
+    "QUARTER": "category",
+    "MONTH": "category",
+    "DAY_OF_MONTH": "category",
+    "DAY_OF_WEEK": "category",
+    "UNIQUE_CARRIER": "category",
+    "TAIL_NUM": "category",
+    "FL_NUM": "category",
+    "ORIGIN": "category",
+    "DEST": "category",
+    "CRS_DEP_TIME": np.int64,
+    "DEP_TIME": np.int64,
+    "DEP_DELAY": np.float64,
+    "DEP_DELAY_NEW": np.float64,
+    "DEP_DEL15": np.int64,
+    "DEP_DELAY_GROUP": np.int64,
+    "CRS_ARR_TIME": np.int64,
+    "ARR_DELAY": np.float64,
+    "CRS_ELAPSED_TIME": np.float64,
+    "DISTANCE": np.float64,
+    "DISTANCE_GROUP": "category",
+}
+
+# narrowest types that hold the values these columns can take: 0/1 flags
+# and delay groups fit 8 bits, hhmm times and years 16 bits, and minute
+# counts and miles are fine as float32
+COMPACT_DTYPES = {
+    "YEAR": np.int16,
+    "CRS_DEP_TIME": np.int16,
+    "DEP_TIME": np.int16,
+    "DEP_DELAY": np.float32,
+    "DEP_DELAY_NEW": np.float32,
+    "DEP_DEL15": np.int8,
+    "DEP_DELAY_GROUP": np.int8,
+    "CRS_ARR_TIME": np.int16,
+    "ARR_DELAY": np.float32,
+    "CRS_ELAPSED_TIME": np.float32,
+    "DISTANCE": np.float32,
+}
+
+# columns the lab drops before encoding
+DROP_COLUMNS = ["YEAR", "TAIL_NUM", "FL_NUM", "DEST"]
+
+TARGET = "ARR_DELAY"
+
+CHUNK_SIZE = 250000
+
+
+def categorical_columns(columns=None):
+    """Return the categorical columns of `DTYPES`, limited to `columns` if given."""
+    return [column for (column, dtype) in DTYPES.items()
+            if dtype == "category" and (columns is None or column in columns)]
+
+
+def downcast(frame, dtypes=COMPACT_DTYPES):
+    """Cast the columns of `frame` named in `dtypes` in place.
+
+    Raises ValueError rather than wrapping around when a value does not fit
+    its narrow integer type, so every chunk of a file comes out with the
+    same dtypes.
+    """
+    for column, dtype in dtypes.items():
+        if column not in frame.columns:
+            continue
+        values = frame[column]
+        if np.issubdtype(dtype, np.integer) and len(values):
+            info = np.iinfo(dtype)
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError("column {} has values outside the {} range".format(column, np.dtype(dtype).name))
+        frame[column] = values.astype(dtype, copy=False)
+    return frame
+
+
+def read_flights(filepath, chunksize=CHUNK_SIZE, drop_columns=DROP_COLUMNS, dtypes=DTYPES,
+                 compact=True):
+    """Lazily yield `chunksize`-row DataFrames of the flight data.
+
+    Columns in `drop_columns` are never parsed. With `compact` the numeric
+    columns are narrowed to `COMPACT_DTYPES`. Categorical columns keep the
+    categories seen in their own chunk; use `load_flights` or an encoder
+    with a fitted vocabulary to line them up across chunks.
+    """
+    header = pd.read_csv(filepath, nrows=0).columns
+    usecols = [column for column in header if column not in set(drop_columns or ())]
+    reader = pd.read_csv(filepath, dtype={c: t for c, t in dtypes.items() if c in usecols},
+                         usecols=usecols, chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            if compact:
+                downcast(chunk)
+            yield chunk
+
+
+def load_flights(filepath, chunksize=CHUNK_SIZE, drop_columns=DROP_COLUMNS, dtypes=DTYPES,
+                 compact=True):
+    """Read the flight data chunk by chunk into one compact DataFrame."""
+    chunks = list(read_flights(filepath, chunksize, drop_columns, dtypes, compact))
+    if not chunks:
+        return pd.read_csv(filepath, nrows=0)
+    for column in categorical_columns(chunks[0].columns):
+        # concat falls back to object dtype unless the categories agree
+        categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Export of the encoded flight features for training.
+#
+# The lab writes its training data with `(train*1).to_csv(...)`: the `*1`
+# copies the whole frame to turn booleans into 0/1, and formatting every
+# value as text dominates the cell's runtime and the file size. The
+# writers below take the sparse matrices produced by
+# `flights_features.SparseOneHotEncoder` one chunk at a time, so nothing
+# is ever densified beyond a single chunk, and write one of:
+#
+#     recordio  sparse RecordIO-protobuf, linear-learner's native input
+#     parquet   columnar Parquet, one row group per chunk
+#     npy       a float32 `.npy` matrix that `np.load(mmap_mode='r')` can map
+#     csv       the lab's format, for comparison
+#
+# Every format stores the label first, as the lab's CSV does. `export`
+# feeds a stream of chunks to several writers and reports each file's size
+# and write time.
+#
+# Usage:
+#     python flights_export.py Flights.csv --formats recordio parquet npy csv
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from flights_data import CHUNK_SIZE, read_flights
+from flights_features import SparseOneHotEncoder
+
+FORMATS = ['recordio', 'parquet', 'npy', 'csv']
+
+EXTENSIONS = {
+    'recordio': '.pbr',
+    'parquet': '.parquet',
+    'npy': '.npy',
+    'csv': '.csv',
+}
+
+CONTENT_TYPES = {
+    'recordio': 'application/x-recordio-protobuf',
+    'parquet': 'application/x-parquet',
+    'npy': 'application/x-npy',
+    'csv': 'text/csv',
+}
+
+
+class CsvWriter:
+    """Headerless CSV with the label in the first column, as the lab writes it."""
+
+    def __init__(self, path, feature_names):
+        self.path = path
+        self.file = open(path, 'w', newline='')
+
+    def write(self, features, labels):
+        frame = pd.DataFrame(features.toarray())
+        frame.insert(0, 'label', labels)
+        frame.to_csv(self.file, header=False, index=False, float_format='%g')
+
+    def close(self):
+        self.file.close()
+
+
+class RecordIOWriter:
+    """Sparse RecordIO-protobuf records, one per row, via the SageMaker SDK."""
+
+    def __init__(self, path, feature_names):
+        import sagemaker.amazon.common as smac
+
+        self.smac = smac
+        self.path = path
+        self.file = open(path, 'wb')
+
+    def write(self, features, labels):
+        self.smac.write_spmatrix_to_sparse_tensor(self.file, features, labels)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Parquet file with a float32 column per feature and one row group per chunk."""
+
+    def __init__(self, path, feature_names):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.names = ['label'] + list(feature_names)
+        schema = pa.schema([(name, pa.float32()) for name in self.names])
+        self.path = path
+        self.writer = pq.ParquetWriter(path, schema, compression='snappy')
+
+    def write(self, features, labels):
+        dense = features.toarray()
+        columns = [self.pa.array(labels, self.pa.float32())]
+        columns.extend(self.pa.array(dense[:, i]) for i in range(dense.shape[1]))
+        self.writer.write_table(self.pa.Table.from_arrays(columns, names=self.names))
+
+    def close(self):
+        self.writer.close()
+
+
+class NpyWriter:
+    """Float32 `.npy` matrix of `[label, features...]` rows written chunk by chunk.
+
+    The row count is only known at the end, so a fixed-size header is
+    reserved up front and rewritten with the final shape on `close`.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, path, feature_names):
+        self.path = path
+        self.columns = len(feature_names) + 1
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(self._header())
+
+    def _header(self):
+        header = repr({'descr': np.dtype(np.float32).str, 'fortran_order': False,
+                       'shape': (self.rows, self.columns)})
+        prefix = b'\x93NUMPY\x01\x00'
+        # magic, version and the 2-byte length, then the dict padded to HEADER_SIZE
+        body_size = self.HEADER_SIZE - len(prefix) - 2
+        body = header.encode('latin1').ljust(body_size - 1) + b'\n'
+        if len(body) != body_size:
+            raise ValueError('shape {} does not fit the .npy header'.format((self.rows, self.columns)))
+        return prefix + body_size.to_bytes(2, 'little') + body
+
+    def write(self, features, labels):
+        block = np.empty((features.shape[0], self.columns), dtype=np.float32)
+        block[:, 0] = labels
+        block[:, 1:] = features.toarray()
+        self.file.write(block.tobytes())
+        self.rows += block.shape[0]
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.close()
+
+
+WRITERS = {
+    'recordio': RecordIOWriter,
+    'parquet': ParquetWriter,
+    'npy': NpyWriter,
+    'csv': CsvWriter,
+}
+
+
+class Exporter:
+    """Writes chunks to one file per format and keeps per-writer timings.
+
+    `basename` gets each format's extension appended. `close` returns a
+    dict of format -> {'path', 'rows', 'bytes', 'seconds'}, where `seconds`
+    is the time spent in that writer alone.
+    """
+
+    def __init__(self, basename, feature_names, formats=FORMATS):
+        self.writers = {fmt: WRITERS[fmt](basename + EXTENSIONS[fmt], feature_names) for fmt in formats}
+        self.seconds = dict.fromkeys(formats, 0.0)
+        self.rows = 0
+
+    def write(self, features, labels):
+        self.rows += features.shape[0]
+        for fmt, writer in self.writers.items():
+            started = time.perf_counter()
+            writer.write(features, labels)
+            self.seconds[fmt] += time.perf_counter() - started
+
+    def close(self):
+        for fmt, writer in self.writers.items():
+            started = time.perf_counter()
+            writer.close()
+            self.seconds[fmt] += time.perf_counter() - started
+        return {fmt: {'path': writer.path,
+                      'rows': self.rows,
+                      'bytes': os.path.getsize(writer.path),
+                      'seconds': round(self.seconds[fmt], 3)}
+                for fmt, writer in self.writers.items()}
+
+
+def export(chunks, basename, feature_names, formats=FORMATS):
+    """Write a stream of `(features, labels)` chunks in each of `formats`; see `Exporter`."""
+    exporter = Exporter(basename, feature_names, formats)
+    try:
+        for features, labels in chunks:
+            exporter.write(features, labels)
+    finally:
+        report = exporter.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Encode Flights.csv and export it for training.')
+    parser.add_argument('filepath', nargs='?', default='Flights.csv')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS)
+    parser.add_argument('--out', default='flights', help='output path without extension')
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    encoder = SparseOneHotEncoder().fit(read_flights(args.filepath, args.chunksize))
+    encoder.save(args.out + '-encoder.json')
+    chunks = (encoder.transform_xy(chunk) for chunk in read_flights(args.filepath, args.chunksize))
+    report = export(chunks, args.out, encoder.feature_names, args.formats)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
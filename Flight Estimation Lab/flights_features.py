@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Sparse one-hot encoding of the flight features.
+#
+# The lab encodes with `pd.get_dummies(data=df, columns=[column])` once per
+# categorical column, copying the whole dense frame each time and adding
+# hundreds of mostly-zero columns. `SparseOneHotEncoder` learns the
+# category vocabulary of each column once (from a frame or a stream of
+# chunks) and turns each frame into a scipy CSR matrix in a single pass.
+# The fitted vocabulary can be saved and loaded, so inference encodes new
+# rows with exactly the mapping used for training.
+#
+# Columns are laid out the way the lab's loop leaves them: the numeric
+# features in frame order, then one block per categorical column with its
+# categories in sorted order, named `<column>_<category>`.
+
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from flights_data import TARGET, categorical_columns
+
+
+class SparseOneHotEncoder:
+    """Fitted mapping from flight frames to sparse feature matrices.
+
+    `categoricals` defaults to the categorical columns of the lab's
+    `dtypes` present in the first frame seen by `fit`; every other column
+    except `target` is passed through as a numeric feature. Categories not
+    seen during fitting, and missing values, encode as all zeros.
+    """
+
+    def __init__(self, categoricals=None, target=TARGET, dtype=np.float32):
+        self.categoricals = list(categoricals) if categoricals is not None else None
+        self.target = target
+        self.dtype = dtype
+        self.numeric = None
+        self.vocabulary = {}
+
+    def _add(self, frame):
+        if self.categoricals is None:
+            self.categoricals = categorical_columns(frame.columns)
+        if self.numeric is None:
+            self.numeric = [column for column in frame.columns
+                            if column not in self.categoricals and column != self.target]
+        for column in self.categoricals:
+            values = frame[column]
+            seen = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.dropna().unique()
+            vocabulary = self.vocabulary.setdefault(column, set())
+            vocabulary.update(str(value) for value in seen)
+        return self
+
+    def fit(self, frames):
+        """Learn the vocabulary from a DataFrame or an iterable of chunks."""
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        for frame in frames:
+            self._add(frame)
+        self._finish()
+        return self
+
+    def _finish(self):
+        self.vocabulary = {column: sorted(categories) for column, categories in self.vocabulary.items()}
+        self._indexes = {column: pd.Index(categories) for column, categories in self.vocabulary.items()}
+        self._offsets = {}
+        offset = len(self.numeric)
+        for column in self.categoricals:
+            self._offsets[column] = offset
+            offset += len(self.vocabulary[column])
+        self.n_features = offset
+
+    @property
+    def feature_names(self):
+        names = list(self.numeric)
+        for column in self.categoricals:
+            names.extend('{}_{}'.format(column, category) for category in self.vocabulary[column])
+        return names
+
+    def transform(self, frame):
+        """Return the features of `frame` as a CSR matrix of `n_features` columns."""
+        n_rows = len(frame)
+        rows, cols, data = [], [], []
+
+        if self.numeric:
+            dense = frame[self.numeric].to_numpy(dtype=self.dtype)
+            nz_rows, nz_cols = np.nonzero(dense)
+            rows.append(nz_rows)
+            cols.append(nz_cols)
+            data.append(dense[nz_rows, nz_cols])
+
+        for column in self.categoricals:
+            codes = self._codes(column, frame[column])
+            known = np.flatnonzero(codes >= 0)
+            rows.append(known)
+            cols.append(codes[known].astype(np.int64) + self._offsets[column])
+            data.append(np.ones(len(known), dtype=self.dtype))
+
+        if rows:
+            rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+        else:
+            rows, cols, data = np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, self.dtype)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(n_rows, self.n_features), dtype=self.dtype)
+
+    def _codes(self, column, values):
+        vocabulary = self._indexes[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # map each category once instead of every row
+            # missing values have code -1, which picks the trailing -1; this also covers a column
+            # with no categories at all (e.g. all NaN)
+            lookup = np.append(vocabulary.get_indexer(values.cat.categories.astype(str)), -1)
+            return lookup[values.cat.codes.to_numpy()]
+        return vocabulary.get_indexer(values.astype(str).where(values.notna()))
+
+    def labels(self, frame):
+        """Return the target column of `frame` as a float32 vector."""
+        return frame[self.target].to_numpy(dtype=np.float32)
+
+    def transform_xy(self, frame):
+        return self.transform(frame), self.labels(frame)
+
+    def to_dict(self):
+        return {
+            'target': self.target,
+            'numeric': self.numeric,
+            'categoricals': self.categoricals,
+            'vocabulary': self.vocabulary,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        encoder = cls(state['categoricals'], state['target'])
+        encoder.numeric = state['numeric']
+        encoder.vocabulary = state['vocabulary']
+        encoder._finish()
+        return encoder
+
+    def save(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.to_dict(), out)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as source:
+            return cls.from_dict(json.load(source))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Linear flight delay model held as NumPy arrays.
+#
+# linear-learner's regressor is `prediction = features . weights + bias`.
+# `LinearModel` keeps that weight vector and bias and scores a whole
+# batch of encoded rows, dense or scipy-sparse, with one matrix-vector
+# product.
+#
+# `load_artifact` reads the `model_output.tar.gz` a SageMaker training job
+# leaves in S3 (a tarball holding the `model_algo-1` zip, which holds an
+# MXNet `.params` file) straight into a `LinearModel`, so the trained model
+# can score flights in-process instead of behind a `linear.deploy(...)`
+# endpoint. MXNet itself is not needed.
+#
+# Usage:
+#     python flights_model.py model_output.tar.gz test.npy
+
+import argparse
+import io
+import json
+import struct
+import tarfile
+import time
+import zipfile
+
+import numpy as np
+
+ARTIFACT_MEMBER = 'model_algo-1'
+
+# MXNet NDArray list file layout
+_LIST_MAGIC = 0x112
+_NDARRAY_MAGICS = (0xF993FAC9, 0xF993FACA)
+# MXNet type flags -> NumPy dtypes
+_MX_DTYPES = {0: np.float32, 1: np.float64, 2: np.float16, 3: np.uint8, 4: np.int32, 5: np.int8, 6: np.int64}
+
+
+class LinearModel:
+    """`features @ weights + bias` for a batch of encoded flight rows."""
+
+    def __init__(self, weights, bias=0.0):
+        self.weights = np.asarray(weights, dtype=np.float32).ravel()
+        self.bias = float(bias)
+
+    @property
+    def feature_dim(self):
+        return self.weights.shape[0]
+
+    def predict(self, features):
+        """Return one predicted delay per row of `features` (n x feature_dim)."""
+        if features.shape[1] != self.feature_dim:
+            raise ValueError('expected {} features, got {}'.format(self.feature_dim, features.shape[1]))
+        return np.asarray(features @ self.weights, dtype=np.float32).ravel() + np.float32(self.bias)
+
+    def mse(self, features, labels):
+        errors = self.predict(features) - np.asarray(labels, dtype=np.float32)
+        return float(np.mean(errors.astype(np.float64) ** 2))
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=np.float32(self.bias))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['weights'], arrays['bias'])
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack_all(self, fmt):
+        values = struct.unpack_from('<' + fmt, self.data, self.offset)
+        self.offset += struct.calcsize('<' + fmt)
+        return values
+
+    def unpack(self, fmt):
+        values = self.unpack_all(fmt)
+        return values if len(values) > 1 else values[0]
+
+    def take(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+
+def read_mxnet_params(data):
+    """Parse an MXNet `.params` file into a dict of name -> NumPy array.
+
+    Only dense arrays are supported, which is all linear-learner saves.
+    Names keep MXNet's `arg:`/`aux:` prefix, if present.
+    """
+    reader = _Reader(data)
+    magic, _reserved, count = reader.unpack('QQQ')
+    if magic != _LIST_MAGIC:
+        raise ValueError('not an MXNet parameter file')
+    arrays = []
+    for _ in range(count):
+        array_magic = reader.unpack('I')
+        if array_magic not in _NDARRAY_MAGICS:
+            raise ValueError('unsupported NDArray format {:#x}'.format(array_magic))
+        storage_type = reader.unpack('i')
+        if storage_type != 0:
+            raise ValueError('sparse NDArrays are not supported')
+        ndim = reader.unpack('I')
+        shape = reader.unpack_all('q' * ndim)
+        _dev_type, _dev_id, type_flag = reader.unpack('iii')
+        dtype = np.dtype(_MX_DTYPES[type_flag])
+        size = int(np.prod(shape)) * dtype.itemsize
+        arrays.append(np.frombuffer(reader.take(size), dtype=dtype).reshape(shape))
+    name_count = reader.unpack('Q')
+    names = []
+    for _ in range(name_count):
+        length = reader.unpack('Q')
+        names.append(reader.take(length).decode('utf-8'))
+    if not names:
+        names = [str(i) for i in range(len(arrays))]
+    return dict(zip(names, arrays))
+
+
+def _param(params, name):
+    for key in (name, 'arg:' + name):
+        if key in params:
+            return params[key]
+    raise KeyError('artifact has no {} parameter'.format(name))
+
+
+def load_artifact(path):
+    """Load a linear-learner `model_output.tar.gz` (or an unpacked `model_algo-1`) as a LinearModel."""
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            member = next(m for m in tar.getmembers() if m.name.rsplit('/', 1)[-1] == ARTIFACT_MEMBER)
+            algo = tar.extractfile(member).read()
+    else:
+        with open(path, 'rb') as artifact:
+            algo = artifact.read()
+
+    with zipfile.ZipFile(io.BytesIO(algo)) as bundle:
+        names = bundle.namelist()
+        if 'additional-params.json' in names:
+            extra = json.loads(bundle.read('additional-params.json'))
+            if extra.get('predictor_type', 'regressor') != 'regressor':
+                raise ValueError('only regressor artifacts are supported, got {}'.format(extra['predictor_type']))
+        params_name = next(name for name in names if name.endswith('.params'))
+        params = read_mxnet_params(bundle.read(params_name))
+
+    return LinearModel(_param(params, 'fc0_weight'), _param(params, 'fc0_bias').ravel()[0])
+
+
+def main(argv=None):
+    from flights_train import iter_batches
+
+    parser = argparse.ArgumentParser(description='Score encoded flights with a trained linear-learner model.')
+    parser.add_argument('model', help='model_output.tar.gz, model_algo-1 or a LinearModel .npz')
+    parser.add_argument('data', help='encoded rows with the label first (.npy, .parquet, .csv or .pbr)')
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--out', help='write the predictions to this .npy file')
+    args = parser.parse_args(argv)
+
+    model = LinearModel.load(args.model) if args.model.endswith('.npz') else load_artifact(args.model)
+    predictions, squared_error, rows = [], 0.0, 0
+    started = time.perf_counter()
+    for features, labels in iter_batches(args.data, args.batch_size, model.feature_dim):
+        scores = model.predict(features)
+        squared_error += float(np.sum((scores.astype(np.float64) - labels) ** 2))
+        rows += len(scores)
+        if args.out:
+            predictions.append(scores)
+    elapsed = time.perf_counter() - started
+    if args.out:
+        np.save(args.out, np.concatenate(predictions) if predictions else np.empty(0, np.float32))
+    print(json.dumps({
+        'rows': rows,
+        'mse': squared_error / rows if rows else None,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Batch scoring of encoded flights.
+#
+# The lab scores with `linear_predictor.predict(test_vector)` on
+# `(test*1).iloc[0][1:]`: one row per request, and the `*1` rebuilds the
+# whole test frame for each of them. `BatchScorer` takes an N x d matrix or
+# a stream of chunks and scores it through a backend:
+#
+#     EndpointBackend  a deployed SageMaker predictor, still using the lab's
+#                      CSVSerializer/JSONDeserializer, but with as many rows
+#                      per request as fit under the payload limit and several
+#                      requests in flight at once
+#     LocalBackend     a `flights_model.LinearModel` scored in-process
+#
+# `evaluate` runs a whole labelled test set through it and reports rows/sec
+# and error metrics.
+#
+# Usage:
+#     python flights_predict.py test.npy --model model_output.tar.gz
+#     python flights_predict.py test.npy --endpoint flight-delays-1690000000
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from flights_model import LinearModel, load_artifact
+from flights_train import iter_batches
+
+# SageMaker real-time endpoints accept request bodies up to 6 MB
+MAX_PAYLOAD_BYTES = 5 * 1024 * 1024
+
+
+def csv_rows(features):
+    """Yield each row of `features` as one CSV line, as CSVSerializer would.
+
+    A sparse matrix is formatted one CSR row at a time, writing only its
+    non-zero cells, so the batch is never densified.
+    """
+    if not sparse.issparse(features):
+        features = np.asarray(features)
+        line = ','.join(['%.9g'] * features.shape[1])
+        for row in features:
+            yield line % tuple(row)
+        return
+    features = features.tocsr()
+    cells = ['0'] * features.shape[1]
+    for i in range(features.shape[0]):
+        start, end = features.indptr[i], features.indptr[i + 1]
+        columns = features.indices[start:end]
+        for j, value in zip(columns, features.data[start:end]):
+            cells[j] = '%.9g' % value
+        yield ','.join(cells)
+        for j in columns:
+            cells[j] = '0'
+
+
+def pack_payloads(rows, max_bytes=MAX_PAYLOAD_BYTES):
+    """Group CSV lines into newline-joined payloads of at most `max_bytes` each.
+
+    Yields `(payload, row_count)`. A single row larger than `max_bytes` is
+    sent on its own.
+    """
+    batch, size = [], 0
+    for row in rows:
+        row_size = len(row) + 1
+        if batch and size + row_size > max_bytes:
+            yield '\n'.join(batch), len(batch)
+            batch, size = [], 0
+        batch.append(row)
+        size += row_size
+    if batch:
+        yield '\n'.join(batch), len(batch)
+
+
+class LocalBackend:
+    """Scores batches in-process with a `LinearModel`."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def score(self, features):
+        return self.model.predict(features)
+
+
+class EndpointBackend:
+    """Scores batches on a SageMaker endpoint with the lab's CSV/JSON serializers.
+
+    `predictor` is a `sagemaker.predictor.Predictor` (e.g. the lab's
+    `linear_predictor`). Each batch is cut into payloads of at most
+    `max_payload_bytes`, and up to `max_in_flight` of them are sent
+    concurrently.
+    """
+
+    def __init__(self, predictor, max_payload_bytes=MAX_PAYLOAD_BYTES, max_in_flight=4):
+        from sagemaker.deserializers import JSONDeserializer
+        from sagemaker.serializers import CSVSerializer
+
+        predictor.serializer = CSVSerializer()
+        predictor.deserializer = JSONDeserializer()
+        self.predictor = predictor
+        self.max_payload_bytes = max_payload_bytes
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.requests = 0
+
+    @classmethod
+    def from_endpoint(cls, endpoint_name, **kwargs):
+        from sagemaker.predictor import Predictor
+
+        return cls(Predictor(endpoint_name), **kwargs)
+
+    def _predict(self, payload, expected):
+        response = self.predictor.predict(payload)
+        scores = [prediction['score'] for prediction in response['predictions']]
+        if len(scores) != expected:
+            raise ValueError('endpoint returned {} predictions for {} rows'.format(len(scores), expected))
+        return scores
+
+    def score(self, features):
+        payloads = list(pack_payloads(csv_rows(features), self.max_payload_bytes))
+        self.requests += len(payloads)
+        futures = [self.executor.submit(self._predict, payload, count) for payload, count in payloads]
+        scores = []
+        for future in futures:
+            scores.extend(future.result())
+        return np.asarray(scores, dtype=np.float32)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class BatchScorer:
+    """Scores matrices or chunk streams through a backend, keeping throughput counters."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.rows = 0
+        self.seconds = 0.0
+
+    def score(self, features):
+        """Return one prediction per row of `features` (dense or sparse N x d)."""
+        started = time.perf_counter()
+        scores = self.backend.score(features)
+        self.seconds += time.perf_counter() - started
+        self.rows += features.shape[0]
+        return scores
+
+    def score_chunks(self, chunks):
+        """Yield predictions for each features matrix in `chunks`."""
+        for features in chunks:
+            yield self.score(features)
+
+    def evaluate(self, batches):
+        """Score a stream of `(features, labels)` and return throughput and error metrics."""
+        rows, squared, absolute, bias = 0, 0.0, 0.0, 0.0
+        for features, labels in batches:
+            errors = self.score(features).astype(np.float64) - np.asarray(labels, dtype=np.float64)
+            rows += len(errors)
+            squared += float(np.dot(errors, errors))
+            absolute += float(np.abs(errors).sum())
+            bias += float(errors.sum())
+        return {
+            'rows': rows,
+            'seconds': round(self.seconds, 3),
+            'rows_per_sec': round(self.rows / self.seconds, 1) if self.seconds else None,
+            'mse': squared / rows if rows else None,
+            'rmse': (squared / rows) ** 0.5 if rows else None,
+            'mae': absolute / rows if rows else None,
+            'mean_error': bias / rows if rows else None,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch-score a labelled test set and report error metrics.')
+    parser.add_argument('data', help='encoded rows with the label first (.npy, .parquet, .csv or .pbr)')
+    backend = parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument('--model', help='model_output.tar.gz, model_algo-1 or a LinearModel .npz')
+    backend.add_argument('--endpoint', help='name of a deployed SageMaker endpoint')
+    parser.add_argument('--feature-dim', type=int, help='needed for .pbr input with --endpoint')
+    parser.add_argument('--batch-size', type=int, default=100000, help='rows read per chunk')
+    parser.add_argument('--max-payload-bytes', type=int, default=MAX_PAYLOAD_BYTES)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    if args.model:
+        model = LinearModel.load(args.model) if args.model.endswith('.npz') else load_artifact(args.model)
+        backend, feature_dim = LocalBackend(model), model.feature_dim
+    else:
+        backend = EndpointBackend.from_endpoint(args.endpoint, max_payload_bytes=args.max_payload_bytes,
+                                                max_in_flight=args.max_in_flight)
+        feature_dim = args.feature_dim
+
+    scorer = BatchScorer(backend)
+    report = scorer.evaluate(iter_batches(args.data, args.batch_size, feature_dim))
+    if isinstance(backend, EndpointBackend):
+        report['requests'] = backend.requests
+        backend.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
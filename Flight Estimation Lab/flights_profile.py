@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Per-stage profile of the flight delay pipeline.
+#
+# The lab times a few cells with `%%time` and never looks at memory, even
+# though the `get_dummies` loop and the `(train*1)` copies are what run
+# out of it. `StageProfiler` records, for every named stage, wall time, CPU
+# time, rows processed, the peak RSS reached while inside it and
+# (optionally) the peak Python heap from `tracemalloc`. The RSS is sampled
+# by a background thread, since the process-wide `ru_maxrss` only ever
+# rises and can't tell one stage's peak from an earlier one's. A stage may
+# be entered many times, once per chunk, and its numbers add up. `profile_pipeline` runs
+# load -> drop -> split -> encode -> export -> train -> score over a
+# Flights.csv and returns the report as a dict, ready to be dumped as JSON
+# by scheduled runs.
+#
+# Usage:
+#     python flights_profile.py Flights.csv --format npy --report profile.json
+#     python flights_profile.py Flights.csv --tracemalloc
+#     python flights_profile.py Flights.csv --mode time --cutoff 10-01
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from flights_data import CHUNK_SIZE, DROP_COLUMNS, read_flights
+from flights_export import EXTENSIONS, Exporter
+from flights_features import SparseOneHotEncoder
+from flights_predict import BatchScorer, LocalBackend
+from flights_split import MODES, StreamSplitter, parse_cutoff
+from flights_train import LocalLinearLearner, iter_batches
+
+STAGES = ['load', 'drop', 'split', 'encode', 'export', 'train', 'score']
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB, or None where it can't be read."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far in MB, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+class RssSampler:
+    """Polls the RSS every `interval` seconds from a daemon thread.
+
+    `watch()` returns `[starting RSS, highest RSS seen since]`, the second
+    kept up to date until `unwatch`; several watches (nested stages) can be
+    open at once.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.watches = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        rss = current_rss_mb()
+        with self.lock:
+            for watch in self.watches:
+                watch[1] = max(watch[1], rss)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def watch(self):
+        rss = current_rss_mb()
+        watch = [rss, rss]
+        with self.lock:
+            self.watches.append(watch)
+        return watch
+
+    def unwatch(self, watch):
+        """Stop updating `watch` and return its peak, in MB."""
+        self._sample()
+        with self.lock:
+            self.watches.remove(watch)
+        return watch[1]
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class StageProfiler:
+    """Accumulates wall/CPU time, rows and memory peaks per named stage.
+
+    A background thread samples the RSS every `rss_interval` seconds, so
+    each stage records the highest RSS reached inside it (`peak_rss_mb`)
+    and how far that was above the RSS it started at (`rss_growth_mb`);
+    `rss_interval=None` turns this off. Allocations shorter than the
+    interval can be missed. With `trace_memory=True` `tracemalloc` runs for
+    the whole profile and each stage records the exact peak traced heap
+    reached while inside it. This makes Python allocations several times
+    slower, so it is off by default.
+    """
+
+    def __init__(self, trace_memory=False, rss_interval=0.01):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.started = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.sampler = RssSampler(rss_interval) if rss_interval and current_rss_mb() is not None else None
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, {
+            'calls': 0,
+            'wall_seconds': 0.0,
+            'cpu_seconds': 0.0,
+            'rows': 0,
+            'peak_rss_mb': None,
+            'rss_growth_mb': 0.0,
+            'peak_traced_mb': None,
+        })
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Time the body as one call of stage `name`; `rows` may also be added later with `add_rows`."""
+        entry = self._entry(name)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        watch = self.sampler.watch() if self.sampler is not None else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield entry
+        finally:
+            entry['wall_seconds'] += time.perf_counter() - wall
+            entry['cpu_seconds'] += time.process_time() - cpu
+            entry['calls'] += 1
+            if rows is not None:
+                entry['rows'] += rows
+            if watch is not None:
+                peak = self.sampler.unwatch(watch)
+                entry['rss_growth_mb'] = max(entry['rss_growth_mb'], peak - watch[0])
+                entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0.0, peak)
+            if self.trace_memory:
+                traced = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                entry['peak_traced_mb'] = max(entry['peak_traced_mb'] or 0.0, traced)
+
+    def add_rows(self, name, rows):
+        self._entry(name)['rows'] += rows
+
+    def report(self):
+        stages = {}
+        # pipeline order first, then any extra stages in the order they ran
+        order = [name for name in STAGES if name in self.stages]
+        order += [name for name in self.stages if name not in STAGES]
+        for name in order:
+            entry = self.stages[name]
+            stages[name] = {key: round(value, 3) if isinstance(value, float) else value
+                            for key, value in entry.items()}
+            wall = entry['wall_seconds']
+            stages[name]['rows_per_sec'] = round(entry['rows'] / wall, 1) if wall and entry['rows'] else None
+        peak = peak_rss_mb()
+        return {
+            'total_seconds': round(time.perf_counter() - self.started, 3),
+            'process_peak_rss_mb': round(peak, 3) if peak is not None else None,
+            'stages': stages,
+        }
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.close()
+            self.sampler = None
+        if self.trace_memory:
+            tracemalloc.stop()
+
+
+def _timed_iter(iterable, profiler, name):
+    """Yield from `iterable`, timing each `next()` as a call of stage `name`."""
+    iterator = iter(iterable)
+    while True:
+        with profiler.stage(name) as entry:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                entry['calls'] -= 1
+                return
+        yield item
+
+
+def profile_pipeline(filepath, workdir, profiler=None, fmt='npy', mode='random', train_frac=0.6,
+                     chunksize=CHUNK_SIZE, epochs=5, cutoff=None, seed=1):
+    """Run the whole flight pipeline under `profiler` and return its report.
+
+    `mode`, `train_frac`, `seed` and `cutoff` configure the
+    `flights_split.StreamSplitter`; the 'time' mode needs a (month, day)
+    `cutoff`.
+    """
+    profiler = profiler or StageProfiler()
+
+    # the encoder vocabulary needs its own pass over the data
+    with profiler.stage('encode'):
+        encoder = SparseOneHotEncoder().fit(read_flights(filepath, chunksize))
+
+    splitter = StreamSplitter(mode, train_frac, seed, cutoff)
+    train_out, test_out = os.path.join(workdir, 'train'), os.path.join(workdir, 'test')
+    train = Exporter(train_out, encoder.feature_names, [fmt])
+    test = Exporter(test_out, encoder.feature_names, [fmt])
+    try:
+        for chunk in _timed_iter(read_flights(filepath, chunksize, drop_columns=()), profiler, 'load'):
+            profiler.add_rows('load', len(chunk))
+            with profiler.stage('drop', rows=len(chunk)):
+                chunk = chunk.drop(columns=[column for column in DROP_COLUMNS if column in chunk.columns])
+            with profiler.stage('split', rows=len(chunk)):
+                mask = splitter.assign(chunk)
+                sides = [(train, chunk[mask]), (test, chunk[~mask])]
+            for exporter, side in sides:
+                if not len(side):
+                    continue
+                with profiler.stage('encode', rows=len(side)):
+                    features, labels = encoder.transform_xy(side)
+                with profiler.stage('export', rows=len(side)):
+                    exporter.write(features, labels)
+    finally:
+        with profiler.stage('export'):
+            train.close()
+            test.close()
+
+    train_path, test_path = train_out + EXTENSIONS[fmt], test_out + EXTENSIONS[fmt]
+    with profiler.stage('train', rows=train.rows):
+        linear = LocalLinearLearner(feature_dim=encoder.n_features, predictor_type='regressor', epochs=epochs)
+        linear.fit({'train': train_path})
+
+    with profiler.stage('score', rows=test.rows):
+        metrics = BatchScorer(LocalBackend(linear.model)).evaluate(
+            iter_batches(test_path, 100000, encoder.n_features))
+
+    report = profiler.report()
+    report['rows'] = {'train': train.rows, 'test': test.rows}
+    report['test_mse'] = metrics['mse']
+    report['training_epochs'] = linear.report['epochs']
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile the flight delay pipeline stage by stage.')
+    parser.add_argument('filepath', nargs='?', default='Flights.csv')
+    parser.add_argument('--format', choices=['npy', 'parquet', 'csv', 'recordio'], default='npy')
+    parser.add_argument('--mode', choices=MODES, default='random')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cutoff', type=parse_cutoff, help="first MM-DD of the test period ('time' mode)")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--tracemalloc', action='store_true', help='also record peak Python heap per stage')
+    parser.add_argument('--workdir', help='where to write the intermediate files (default: a temp dir)')
+    parser.add_argument('--report', help='also write the JSON report to this file')
+    args = parser.parse_args(argv)
+    if args.mode == 'time' and args.cutoff is None:
+        parser.error("--mode time needs --cutoff MM-DD")
+
+    profiler = StageProfiler(trace_memory=args.tracemalloc)
+    with tempfile.TemporaryDirectory(prefix='flights-profile-') as tmp:
+        report = profile_pipeline(args.filepath, args.workdir or tmp, profiler, args.format, args.mode,
+                                  chunksize=args.chunksize, epochs=args.epochs, cutoff=args.cutoff, seed=args.seed)
+    profiler.close()
+    report['settings'] = {'format': args.format, 'mode': args.mode, 'seed': args.seed,
+                          'cutoff': args.cutoff and '%02d-%02d' % args.cutoff, 'chunksize': args.chunksize,
+                          'epochs': args.epochs, 'tracemalloc': args.tracemalloc}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.report:
+        with open(args.report, 'w') as out:
+            out.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Online delay estimates for single flights.
+#
+# Scoring one raw flight record through the encoder builds a whole sparse
+# matrix for a row that only has a handful of active features. `FeatureIndex`
+# instead folds the fitted `SparseOneHotEncoder` layout and the model's
+# weights into lookup tables once: the weight of every numeric column, and
+# a category -> (column index, weight) table per categorical column. A
+# prediction is then the bias plus a dot product over the numeric values
+# plus one table lookup per categorical column.
+#
+# `ScoringService` serves it over HTTP with asyncio. A lone request is
+# scored straight away; under concurrent load requests arriving within
+# `window_ms` of each other are micro-batched into one vectorized pass.
+#
+# Usage:
+#     python flights_service.py --encoder encoder.json --model model_output.tar.gz --port 8080
+#     curl -d '{"ORIGIN": "ATL", "UNIQUE_CARRIER": "DL", "MONTH": 7, ...}' localhost:8080/predict
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import numpy as np
+
+from flights_features import SparseOneHotEncoder
+from flights_model import LinearModel, load_artifact
+
+
+def category_key(value):
+    """Spell a raw JSON value the way the encoder's vocabulary does ('7', not 7 or 7.0)."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+class FeatureIndex:
+    """Precomputed feature layout and weights of an encoder/model pair.
+
+    `numeric_weights` holds the weights of the numeric columns and
+    `lookup[column][category]` the weight of each dummy feature, as laid
+    out by the lab's `pd.get_dummies` loop. Unknown categories contribute
+    nothing, as they do in the encoder.
+    """
+
+    def __init__(self, encoder, model):
+        if encoder.n_features != model.feature_dim:
+            raise ValueError('encoder has {} features but the model expects {}'.format(
+                encoder.n_features, model.feature_dim))
+        self.numeric = list(encoder.numeric)
+        self.numeric_weights = model.weights[:len(self.numeric)].astype(np.float64)
+        self.bias = model.bias
+        self.lookup = {}
+        offset = len(self.numeric)
+        for column in encoder.categoricals:
+            categories = encoder.vocabulary[column]
+            self.lookup[column] = {category: float(model.weights[offset + i]) for i, category in enumerate(categories)}
+            offset += len(categories)
+
+    def score(self, record):
+        """Predict the arrival delay of one raw flight record (a dict)."""
+        return self.score_batch([record])[0]
+
+    def score_batch(self, records):
+        """Predict a list of raw flight records in one vectorized pass."""
+        try:
+            values = np.array([[record[column] for column in self.numeric] for record in records], dtype=np.float64)
+        except KeyError as error:
+            raise ValueError('missing feature {}'.format(error.args[0])) from None
+        except OverflowError:
+            # a JSON integer too large for a float64 (e.g. 400 digits) would be inf
+            for row, record in enumerate(records):
+                for column in self.numeric:
+                    if isinstance(record[column], int) and abs(record[column]) > sys.float_info.max:
+                        raise ValueError('feature {} of record {} is null or not finite'.format(column, row)) from None
+            raise ValueError('a numeric feature is not finite') from None
+        values = values.reshape(len(records), len(self.numeric))
+        finite = np.isfinite(values)
+        if not finite.all():
+            # null would score as NaN, which isn't valid JSON
+            row, column = np.argwhere(~finite)[0]
+            raise ValueError('feature {} of record {} is null or not finite'.format(self.numeric[column], row))
+        scores = values @ self.numeric_weights + self.bias
+        for column, weights in self.lookup.items():
+            scores += np.fromiter((weights.get(category_key(record.get(column)), 0.0) for record in records),
+                                  dtype=np.float64, count=len(records))
+        return scores
+
+
+class MicroBatcher:
+    """Scores concurrent requests together.
+
+    A request that finds no others queued is scored at once. When several
+    are queued, more are collected for up to `window` seconds (or
+    `max_batch` records) and the whole batch is scored in one pass.
+    """
+
+    def __init__(self, index, window=0.002, max_batch=256):
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.records = 0
+
+    async def score(self, record):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((record, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            # let requests that arrived together queue up, then take them without waiting
+            await asyncio.sleep(0)
+            while len(pending) < self.max_batch and not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            if len(pending) == 1:
+                # a lone request is scored right away; only concurrent load waits out the window
+                self._score(pending)
+                continue
+            deadline = loop.time() + self.window
+            while len(pending) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._score(pending)
+
+    def _score(self, pending):
+        """Score `pending` and resolve its futures; never raises, so `run` keeps serving."""
+        self.batches += 1
+        self.records += len(pending)
+        try:
+            scores = self.index.score_batch([record for record, _ in pending])
+        except Exception:
+            # score one by one so a bad record only fails its own request
+            for record, future in pending:
+                try:
+                    result = float(self.index.score(record))
+                except (ValueError, TypeError) as error:
+                    if not future.done():
+                        future.set_exception(ValueError(str(error)))
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            return
+        for (_, future), score in zip(pending, scores):
+            if not future.done():
+                future.set_result(float(score))
+
+
+class ScoringService:
+    """Minimal HTTP/1.1 server for `POST /predict` and `GET /health`.
+
+    `/predict` takes a JSON flight record, or a list of them, and answers
+    `{"predictions": [{"score": ...}, ...]}` like the SageMaker endpoint.
+    """
+
+    def __init__(self, index, host='127.0.0.1', port=8080, window_ms=2.0, max_batch=256):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.batcher = MicroBatcher(index, window_ms / 1000, max_batch)
+        self.server = None
+
+    async def start(self):
+        self.batch_task = asyncio.ensure_future(self.batcher.run())
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batch_task.cancel()
+
+    async def _predict(self, body):
+        payload = json.loads(body)
+        records = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(record, dict) for record in records):
+            raise ValueError('expected a flight record or a list of them')
+        scores = await asyncio.gather(*(self.batcher.score(record) for record in records))
+        return {'predictions': [{'score': score} for score in scores]}
+
+    async def _respond(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'batches': self.batcher.batches, 'records': self.batcher.records}
+        if method == 'POST' and path in ('/predict', '/invocations'):
+            started = time.perf_counter()
+            try:
+                result = await self._predict(body)
+            except ValueError as error:
+                return 400, {'error': str(error)}
+            except Exception as error:
+                return 500, {'error': '{}: {}'.format(type(error).__name__, error)}
+            result['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            return 200, result
+        return 404, {'error': 'not found'}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _version = request_line.decode('latin1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, result = await self._respond(method, path, body)
+                data = json.dumps(result).encode('utf-8')
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                             .format(status, reason, len(data)).encode('latin1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve single-flight delay predictions over HTTP.')
+    parser.add_argument('--encoder', required=True, help='encoder JSON saved by SparseOneHotEncoder.save')
+    parser.add_argument('--model', required=True, help='model_output.tar.gz, model_algo-1 or a LinearModel .npz')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window-ms', type=float, default=2.0, help='micro-batching window')
+    parser.add_argument('--max-batch', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    encoder = SparseOneHotEncoder.load(args.encoder)
+    model = LinearModel.load(args.model) if args.model.endswith('.npz') else load_artifact(args.model)
+    service = ScoringService(FeatureIndex(encoder, model), args.host, args.port, args.window_ms, args.max_batch)
+
+    async def serve():
+        await service.start()
+        print('serving on http://{}:{}'.format(service.host, service.port))
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Streaming train/test split of the flight data.
+#
+# The lab splits with `train = df.sample(frac=0.6, random_state=1)` and
+# `test = df.drop(train.index)`, which needs the whole frame in memory plus
+# two materialized copies and an index difference. `split_chunks` decides
+# each row's side from the row itself, one chunk at a time, so the split
+# can be written out as the file streams past. Three modes:
+#
+#     random      a seeded hash of the row's values, compared with `train_frac`;
+#                 the same row gets the same side on every run and chunking
+#     stratified  rows are bucketed by arrival delay (`DELAY_BUCKETS`) and each
+#                 bucket is split in exactly `train_frac` proportion, in file order
+#     time        flights before a (month, day) cutoff train, the rest test
+#
+# Usage:
+#     python flights_split.py Flights.csv --mode random --train-frac 0.6 --formats recordio
+#     python flights_split.py Flights.csv --mode time --cutoff 10-01 --formats npy
+
+import argparse
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from flights_data import CHUNK_SIZE, TARGET, read_flights
+from flights_export import FORMATS, Exporter
+from flights_features import SparseOneHotEncoder
+
+MODES = ['random', 'stratified', 'time']
+
+# arrival delay bucket edges in minutes: early, on time, late, very late
+DELAY_BUCKETS = [-15.0, 0.0, 15.0, 60.0]
+
+
+def _hash_key(seed):
+    # hash_pandas_object wants a 16 character key
+    return hashlib.md5(str(seed).encode('ascii')).hexdigest()[:16]
+
+
+def row_hash_fraction(chunk, seed=1):
+    """Map every row of `chunk` to a number in [0, 1) from a seeded hash of its values."""
+    hashes = pd.util.hash_pandas_object(chunk, index=False, hash_key=_hash_key(seed)).to_numpy()
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+class StreamSplitter:
+    """Stateful row -> train/test assignment for a stream of chunks.
+
+    Call `assign(chunk)` on consecutive chunks; it returns a boolean mask
+    that is True for training rows.
+    """
+
+    def __init__(self, mode='random', train_frac=0.6, seed=1, cutoff=None, target=TARGET,
+                 buckets=DELAY_BUCKETS):
+        if mode not in MODES:
+            raise ValueError('unknown split mode: %r' % mode)
+        if mode == 'time' and cutoff is None:
+            raise ValueError("the 'time' split needs a (month, day) cutoff")
+        self.mode = mode
+        self.train_frac = train_frac
+        self.seed = seed
+        self.cutoff = cutoff
+        self.target = target
+        self.buckets = np.asarray(buckets, dtype=np.float64)
+        # per bucket: rows seen so far, and a seeded phase so buckets don't all start on train
+        self.seen = np.zeros(len(self.buckets) + 2, dtype=np.int64)
+        self.phase = np.random.default_rng(seed).random(len(self.seen))
+
+    def assign(self, chunk):
+        if self.mode == 'random':
+            return row_hash_fraction(chunk, self.seed) < self.train_frac
+        if self.mode == 'time':
+            month = chunk['MONTH'].astype(int).to_numpy()
+            day = chunk['DAY_OF_MONTH'].astype(int).to_numpy()
+            return month * 100 + day < self.cutoff[0] * 100 + self.cutoff[1]
+        return self._stratified(chunk)
+
+    def _stratified(self, chunk):
+        delays = chunk[self.target].to_numpy(dtype=np.float64)
+        # missing delays get a bucket of their own
+        bucket = np.where(np.isnan(delays), len(self.buckets) + 1,
+                          np.searchsorted(self.buckets, delays, side='right'))
+        mask = np.empty(len(chunk), dtype=bool)
+        for b in np.unique(bucket):
+            rows = np.flatnonzero(bucket == b)
+            # systematic sampling: row n of a bucket trains when floor(n * frac + phase) steps up
+            n = self.seen[b] + np.arange(1, len(rows) + 1)
+            taken = np.floor(n * self.train_frac + self.phase[b])
+            mask[rows] = taken > np.floor((n - 1) * self.train_frac + self.phase[b])
+            self.seen[b] += len(rows)
+        return mask
+
+
+def split_chunks(chunks, splitter):
+    """Yield `(train, test)` frame pairs for each chunk of a stream."""
+    for chunk in chunks:
+        mask = splitter.assign(chunk)
+        yield chunk[mask], chunk[~mask]
+
+
+def split_and_export(filepath, encoder, splitter, formats=FORMATS, train_out='train', test_out='test',
+                     chunksize=CHUNK_SIZE, sink_factory=None):
+    """Encode and split `filepath` in one streaming pass, writing train and test files.
+
+    `sink_factory(basename)` may return another sink with the `Exporter`
+    interface (`write(features, labels)` and `close()`). Returns the
+    reports of both sides.
+    """
+    if sink_factory is None:
+        def sink_factory(basename):
+            return Exporter(basename, encoder.feature_names, formats)
+    train = sink_factory(train_out)
+    test = sink_factory(test_out)
+    try:
+        for train_chunk, test_chunk in split_chunks(read_flights(filepath, chunksize), splitter):
+            if len(train_chunk):
+                train.write(*encoder.transform_xy(train_chunk))
+            if len(test_chunk):
+                test.write(*encoder.transform_xy(test_chunk))
+    finally:
+        reports = {'train': train.close(), 'test': test.close()}
+    return reports
+
+
+def parse_cutoff(text):
+    month, day = text.split('-')
+    return int(month), int(day)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split Flights.csv into train and test files in one pass.')
+    parser.add_argument('filepath', nargs='?', default='Flights.csv')
+    parser.add_argument('--mode', choices=MODES, default='random')
+    parser.add_argument('--train-frac', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cutoff', type=parse_cutoff, help="first MM-DD of the test period ('time' mode)")
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['recordio'])
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--encoder', default='encoder.json', help='where to save the fitted encoder')
+    args = parser.parse_args(argv)
+
+    encoder = SparseOneHotEncoder().fit(read_flights(args.filepath, args.chunksize))
+    encoder.save(args.encoder)
+    splitter = StreamSplitter(args.mode, args.train_frac, args.seed, args.cutoff)
+    reports = split_and_export(args.filepath, encoder, splitter, args.formats, chunksize=args.chunksize)
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
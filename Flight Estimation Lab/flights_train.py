@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Local stand-in for the SageMaker linear-learner training job.
+#
+# The lab trains with `sagemaker.estimator.Estimator` on an `ml.m4.xlarge`
+# instance, which needs cloud access. `LocalLinearLearner` takes the same
+# `feature_dim` / `predictor_type='regressor'` hyperparameters and `fit`
+# channels and trains the same kind of model on this machine: mini-batch
+# SGD with Adam on squared loss, with features and label normalized from a
+# sample of the data first, as linear-learner does by default. Like
+# `input_mode='Pipe'`, each epoch streams the training file from disk in
+# mini-batches rather than loading it, from any file `flights_export` can
+# write (`.npy` is memory mapped). In-memory `(features, labels)` pairs,
+# sparse or dense, work too.
+#
+# Usage:
+#     python flights_train.py train.npy test.npy --feature-dim 137 --model model.npz
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from flights_model import LinearModel
+
+DEFAULT_HYPERPARAMETERS = {
+    'feature_dim': None,
+    'predictor_type': 'regressor',
+    'mini_batch_size': 1000,
+    'epochs': 15,
+    'learning_rate': 0.005,
+    'beta_1': 0.9,
+    'beta_2': 0.999,
+    'wd': 0.0,
+    'normalize_data': True,
+    'normalize_label': True,
+    'num_point_for_scaler': 10000,
+    'early_stopping_patience': 3,
+    'early_stopping_tolerance': 0.001,
+}
+
+
+def _iter_npy(path, batch_size):
+    data = np.load(path, mmap_mode='r')
+    for start in range(0, data.shape[0], batch_size):
+        block = np.asarray(data[start:start + batch_size], dtype=np.float32)
+        yield block[:, 1:], block[:, 0]
+
+
+def _iter_parquet(path, batch_size):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        block = np.column_stack([column.to_numpy(zero_copy_only=False) for column in batch.columns])
+        block = block.astype(np.float32, copy=False)
+        yield block[:, 1:], block[:, 0]
+
+
+def _iter_csv(path, batch_size):
+    for chunk in pd.read_csv(path, header=None, chunksize=batch_size, dtype=np.float32):
+        block = chunk.to_numpy()
+        yield block[:, 1:], block[:, 0]
+
+
+def _iter_recordio(path, batch_size, feature_dim):
+    from sagemaker.amazon.common import read_records
+    from sagemaker.amazon.record_pb2 import Record
+
+    def flush(rows, cols, values, labels):
+        features = sparse.csr_matrix((values, (rows, cols)), shape=(len(labels), feature_dim), dtype=np.float32)
+        return features, np.asarray(labels, dtype=np.float32)
+
+    rows, cols, values, labels = [], [], [], []
+    with open(path, 'rb') as records:
+        for raw in read_records(records):
+            record = Record()
+            record.ParseFromString(raw)
+            tensor = record.features['values'].float32_tensor
+            rows.extend([len(labels)] * len(tensor.values))
+            cols.extend(tensor.keys)
+            values.extend(tensor.values)
+            labels.append(record.label['values'].float32_tensor.values[0])
+            if len(labels) >= batch_size:
+                yield flush(rows, cols, values, labels)
+                rows, cols, values, labels = [], [], [], []
+    if labels:
+        yield flush(rows, cols, values, labels)
+
+
+def iter_batches(source, batch_size, feature_dim=None):
+    """Yield `(features, labels)` mini-batches from a file path or an in-memory pair."""
+    if isinstance(source, tuple):
+        features, labels = source
+        features = features.tocsr() if sparse.issparse(features) else features
+        for start in range(0, features.shape[0], batch_size):
+            yield features[start:start + batch_size], np.asarray(labels[start:start + batch_size], dtype=np.float32)
+    elif source.endswith('.npy'):
+        yield from _iter_npy(source, batch_size)
+    elif source.endswith('.parquet'):
+        yield from _iter_parquet(source, batch_size)
+    elif source.endswith('.csv'):
+        yield from _iter_csv(source, batch_size)
+    elif source.endswith('.pbr'):
+        yield from _iter_recordio(source, batch_size, feature_dim)
+    else:
+        raise ValueError('unsupported training data: %r' % (source,))
+
+
+def _column_sums(features):
+    return np.asarray(features.sum(axis=0), dtype=np.float64).ravel()
+
+
+def _squared_column_sums(features):
+    squared = features.multiply(features) if sparse.issparse(features) else np.square(features, dtype=np.float64)
+    return np.asarray(squared.sum(axis=0), dtype=np.float64).ravel()
+
+
+class LocalLinearLearner:
+    """linear-learner regressor trained in-process.
+
+    Mirrors the parts of `sagemaker.estimator.Estimator` the lab uses:
+    `set_hyperparameters(...)` then `fit({'train': ..., 'test': ...})`.
+    Channels are file paths or `(features, labels)` pairs; an optional
+    'validation' channel drives early stopping, otherwise the training
+    loss does. After `fit`, `model` holds the `LinearModel` of the epoch
+    with the lowest loss, in raw feature space, and `report` the test MSE,
+    throughput and convergence time.
+    """
+
+    def __init__(self, **hyperparameters):
+        self.hyperparameters = dict(DEFAULT_HYPERPARAMETERS)
+        self.set_hyperparameters(**hyperparameters)
+        self.model = None
+        self.report = None
+
+    def set_hyperparameters(self, **hyperparameters):
+        unknown = set(hyperparameters) - set(DEFAULT_HYPERPARAMETERS)
+        if unknown:
+            raise ValueError('unsupported hyperparameters: {}'.format(', '.join(sorted(unknown))))
+        if hyperparameters.get('predictor_type', 'regressor') != 'regressor':
+            raise ValueError("only predictor_type='regressor' is supported")
+        self.hyperparameters.update(hyperparameters)
+
+    def _batches(self, source):
+        hp = self.hyperparameters
+        return iter_batches(source, hp['mini_batch_size'], hp['feature_dim'])
+
+    def _fit_scaler(self, source):
+        """Estimate feature/label mean and scale from the first `num_point_for_scaler` rows."""
+        hp = self.hyperparameters
+        dim = hp['feature_dim']
+        sums, squares, rows = np.zeros(dim), np.zeros(dim), 0
+        label_sum, label_squares = 0.0, 0.0
+        for features, labels in self._batches(source):
+            sums += _column_sums(features)
+            squares += _squared_column_sums(features)
+            label_sum += float(np.sum(labels, dtype=np.float64))
+            label_squares += float(np.sum(np.square(labels, dtype=np.float64)))
+            rows += features.shape[0]
+            if rows >= hp['num_point_for_scaler']:
+                break
+
+        self.mean = np.zeros(dim)
+        self.scale = np.ones(dim)
+        if hp['normalize_data'] and rows:
+            mean = sums / rows
+            std = np.sqrt(np.maximum(squares / rows - mean ** 2, 0.0))
+            self.scale = np.where(std > 0, 1.0 / np.where(std > 0, std, 1.0), 1.0)
+            self.mean = mean
+        self.label_mean, self.label_scale = 0.0, 1.0
+        if hp['normalize_label'] and rows:
+            self.label_mean = label_sum / rows
+            label_std = np.sqrt(max(label_squares / rows - self.label_mean ** 2, 0.0))
+            self.label_scale = label_std if label_std > 0 else 1.0
+
+    def _raw_model(self, weights, bias):
+        # fold the normalization back in so the model takes raw encoded rows
+        raw_weights = weights * self.scale * self.label_scale
+        raw_bias = (bias - float(np.dot(self.mean, weights * self.scale))) * self.label_scale + self.label_mean
+        return LinearModel(raw_weights, raw_bias)
+
+    def _mse(self, model, source):
+        total, rows = 0.0, 0
+        for features, labels in self._batches(source):
+            errors = model.predict(features).astype(np.float64) - labels
+            total += float(np.dot(errors, errors))
+            rows += features.shape[0]
+        return total / rows if rows else float('nan')
+
+    def fit(self, inputs):
+        """Train on `inputs['train']`; score `inputs['test']` at the end if given."""
+        hp = self.hyperparameters
+        if hp['feature_dim'] is None:
+            raise ValueError('feature_dim must be set')
+        train = inputs['train']
+        validation = inputs.get('validation')
+        self._fit_scaler(train)
+
+        dim = hp['feature_dim']
+        weights, bias = np.zeros(dim), 0.0
+        m_w, v_w, m_b, v_b = np.zeros(dim), np.zeros(dim), 0.0, 0.0
+        beta_1, beta_2, lr, eps = hp['beta_1'], hp['beta_2'], hp['learning_rate'], 1e-8
+        step = 0
+        best_loss, stale_epochs = float('inf'), 0
+        # the model returned is the lowest-loss epoch's, not the last one's
+        best_model, best_epoch = None, None
+        history = []
+        started = time.perf_counter()
+        converged_at = None
+        rows_seen = 0
+
+        for epoch in range(1, hp['epochs'] + 1):
+            epoch_loss, epoch_rows = 0.0, 0
+            for features, labels in self._batches(train):
+                n = features.shape[0]
+                scaled_w = weights * self.scale
+                # prediction on normalized features: (x - mean) * scale . weights + bias
+                predictions = np.asarray(features @ scaled_w).ravel() - np.dot(self.mean, scaled_w) + bias
+                residuals = predictions - (labels - self.label_mean) / self.label_scale
+                grad_w = self.scale * (np.asarray(features.T @ residuals).ravel() - self.mean * residuals.sum()) / n
+                grad_w += hp['wd'] * weights
+                grad_b = float(residuals.mean())
+
+                step += 1
+                m_w = beta_1 * m_w + (1 - beta_1) * grad_w
+                v_w = beta_2 * v_w + (1 - beta_2) * grad_w ** 2
+                m_b = beta_1 * m_b + (1 - beta_1) * grad_b
+                v_b = beta_2 * v_b + (1 - beta_2) * grad_b ** 2
+                correction = np.sqrt(1 - beta_2 ** step) / (1 - beta_1 ** step)
+                weights -= lr * correction * m_w / (np.sqrt(v_w) + eps)
+                bias -= lr * correction * m_b / (np.sqrt(v_b) + eps)
+
+                epoch_loss += float(np.dot(residuals, residuals)) * self.label_scale ** 2
+                epoch_rows += n
+            rows_seen += epoch_rows
+
+            model = self._raw_model(weights, bias)
+            loss = self._mse(model, validation) if validation is not None else epoch_loss / max(epoch_rows, 1)
+            history.append({'epoch': epoch, 'loss': loss, 'seconds': round(time.perf_counter() - started, 3)})
+            if best_model is None or loss < history[best_epoch - 1]['loss']:
+                best_model, best_epoch = model, epoch
+            if loss < best_loss * (1 - hp['early_stopping_tolerance']):
+                best_loss, stale_epochs = loss, 0
+                converged_at = history[-1]
+            else:
+                stale_epochs += 1
+                if stale_epochs >= hp['early_stopping_patience']:
+                    break
+
+        elapsed = time.perf_counter() - started
+        self.model = best_model if best_model is not None else self._raw_model(weights, bias)
+        self.report = {
+            'epochs': len(history),
+            'best_epoch': best_epoch,
+            'train_seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows_seen / elapsed, 1) if elapsed else None,
+            'converged_epoch': converged_at['epoch'] if converged_at else None,
+            'seconds_to_convergence': converged_at['seconds'] if converged_at else None,
+            'history': history,
+        }
+        if inputs.get('test') is not None:
+            self.report['test_mse'] = self._mse(self.model, inputs['test'])
+        return self.model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the flight delay regressor locally.')
+    parser.add_argument('train', help='training data (.npy, .parquet, .csv or .pbr, label first)')
+    parser.add_argument('test', nargs='?', help='test data in the same format')
+    parser.add_argument('--validation', help='validation data for early stopping')
+    parser.add_argument('--feature-dim', type=int, required=True)
+    parser.add_argument('--epochs', type=int, default=DEFAULT_HYPERPARAMETERS['epochs'])
+    parser.add_argument('--mini-batch-size', type=int, default=DEFAULT_HYPERPARAMETERS['mini_batch_size'])
+    parser.add_argument('--learning-rate', type=float, default=DEFAULT_HYPERPARAMETERS['learning_rate'])
+    parser.add_argument('--model', default='model.npz', help='where to save the trained weights')
+    args = parser.parse_args(argv)
+
+    linear = LocalLinearLearner(feature_dim=args.feature_dim,
+                                predictor_type='regressor',
+                                epochs=args.epochs,
+                                mini_batch_size=args.mini_batch_size,
+                                learning_rate=args.learning_rate)
+    linear.fit({'train': args.train, 'test': args.test, 'validation': args.validation})
+    linear.model.save(args.model)
+    print(json.dumps(linear.report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Streaming upload of the training data to S3.
+#
+# The lab writes all of `train.csv` and `test.csv`, then uploads them one
+# after the other with `Object(...).upload_file(...)` on default transfer
+# settings. Here the exported data is cut into shards of `shard_rows` rows
+# (`ShardedSink`), and each shard is handed to `ShardUploader` as soon as
+# it is closed, so uploading overlaps with encoding and writing. Train and
+# test shards share one uploader pool, and every shard goes up as a
+# multipart upload with tuned part size and concurrency. SageMaker training
+# channels take an S3 prefix, so the shards under `<prefix>/train/` and
+# `<prefix>/test/` can be used as the lab's `s3_train_data`/`s3_test_data`.
+#
+# `LocalS3` is a small S3-compatible server (put, get, head and multipart
+# upload, no auth) for running the whole path without AWS.
+#
+# Usage:
+#     python flights_upload.py Flights.csv --bucket my-bucket --formats recordio
+#     python flights_upload.py Flights.csv --local-s3 --formats npy
+#     python flights_upload.py Flights.csv --local-s3 --mode time --cutoff 10-01
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.etree import ElementTree
+
+from flights_data import CHUNK_SIZE, read_flights
+from flights_export import CONTENT_TYPES, FORMATS, Exporter
+from flights_features import SparseOneHotEncoder
+from flights_split import MODES, StreamSplitter, parse_cutoff, split_and_export
+
+MB = 1024 * 1024
+
+
+def make_s3_client(endpoint_url=None, max_pool_connections=32):
+    """Return a boto3 S3 client; `endpoint_url` points it at an S3-compatible server instead of AWS."""
+    import boto3
+    from botocore.config import Config
+
+    options = {'max_pool_connections': max_pool_connections}
+    if endpoint_url:
+        # path-style URLs, and no streaming checksums, which simple S3 stand-ins don't decode
+        options.update(s3={'addressing_style': 'path'}, request_checksum_calculation='when_required')
+        return boto3.client('s3', endpoint_url=endpoint_url, config=Config(**options),
+                            aws_access_key_id='local', aws_secret_access_key='local', region_name='us-east-1')
+    return boto3.client('s3', config=Config(**options))
+
+
+class ShardUploader:
+    """Uploads files to S3 on a thread pool while more are still being written.
+
+    `max_files` shards upload at once, each as a multipart upload of
+    `multipart_chunksize` parts with `max_concurrency` parts in flight.
+    `wait` blocks until everything submitted is uploaded and returns the
+    throughput report.
+    """
+
+    def __init__(self, bucket, client=None, max_files=4, multipart_chunksize=8 * MB,
+                 multipart_threshold=8 * MB, max_concurrency=8, delete_uploaded=False):
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.client = client or make_s3_client(max_pool_connections=max_files * max_concurrency)
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency,
+                                              use_threads=True)
+        self.delete_uploaded = delete_uploaded
+        self.executor = ThreadPoolExecutor(max_workers=max_files)
+        self.futures = []
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.started = None
+        self.keys = []
+
+    def submit(self, path, key, content_type=None):
+        with self.lock:
+            if self.started is None:
+                self.started = time.perf_counter()
+        self.futures.append(self.executor.submit(self._upload, path, key, content_type))
+
+    def _upload(self, path, key, content_type):
+        size = os.path.getsize(path)
+        extra = {'ContentType': content_type} if content_type else None
+        self.client.upload_file(path, self.bucket, key, ExtraArgs=extra, Config=self.transfer_config)
+        with self.lock:
+            self.bytes += size
+            self.keys.append(key)
+        if self.delete_uploaded:
+            os.remove(path)
+        return key
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {
+            'files': len(self.keys),
+            'bytes': self.bytes,
+            'seconds': round(elapsed, 3),
+            'mb_per_sec': round(self.bytes / MB / elapsed, 2) if elapsed else None,
+        }
+
+
+class ShardedSink:
+    """`Exporter` look-alike that rolls over to a new shard every `shard_rows` rows.
+
+    Each finished shard file is submitted to `uploader` under
+    `<key_prefix>/<shard name>` straight away.
+    """
+
+    def __init__(self, basename, feature_names, formats, uploader, key_prefix, shard_rows=500000):
+        self.basename = basename
+        self.feature_names = feature_names
+        self.formats = formats
+        self.uploader = uploader
+        self.key_prefix = key_prefix.rstrip('/')
+        self.shard_rows = shard_rows
+        self.shards = 0
+        self.rows = 0
+        self.current = None
+        self.reports = []
+
+    def _roll(self):
+        if self.current is not None:
+            report = self.current.close()
+            for fmt, entry in report.items():
+                key = '{}/{}'.format(self.key_prefix, os.path.basename(entry['path']))
+                self.uploader.submit(entry['path'], key, CONTENT_TYPES[fmt])
+            self.reports.append(report)
+            self.current = None
+
+    def write(self, features, labels):
+        start = 0
+        while start < features.shape[0]:
+            if self.current is None:
+                self.current = Exporter('{}-{:05d}'.format(self.basename, self.shards), self.feature_names,
+                                        self.formats)
+                self.shards += 1
+            take = min(features.shape[0] - start, self.shard_rows - self.current.rows)
+            self.current.write(features[start:start + take], labels[start:start + take])
+            start += take
+            if self.current.rows >= self.shard_rows:
+                self._roll()
+        self.rows += features.shape[0]
+
+    def close(self):
+        self._roll()
+        return {'shards': self.shards, 'rows': self.rows,
+                's3_uri': 's3://{}/{}/'.format(self.uploader.bucket, self.key_prefix)}
+
+
+class _LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _target(self):
+        url = urlparse(self.path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, root, children):
+        parts = ''.join('<{0}>{1}</{0}>'.format(name, value) for name, value in children.items())
+        return ('<?xml version="1.0" encoding="UTF-8"?><{0} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">{1}</{0}>'
+                .format(root, parts)).encode('utf-8')
+
+    def do_PUT(self):
+        store = self.server.store
+        bucket, key, query = self._target()
+        body = self._body()
+        if not key:
+            store.create_bucket(bucket)
+            self._send(200)
+        elif 'uploadId' in query:
+            etag = store.put_part(query['uploadId'], int(query['partNumber']), body)
+            self._send(200, headers={'ETag': etag})
+        else:
+            etag = store.put(bucket, key, body, self.headers.get('Content-Type'))
+            self._send(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        store = self.server.store
+        bucket, key, query = self._target()
+        body = self._body()
+        if 'uploads' in query:
+            upload_id = store.create_upload(bucket, key, self.headers.get('Content-Type'))
+            self._send(200, self._xml('InitiateMultipartUploadResult',
+                                      {'Bucket': bucket, 'Key': key, 'UploadId': upload_id}))
+        elif 'uploadId' in query:
+            parts = [int(element.text) for element in ElementTree.fromstring(body).iter()
+                     if element.tag.endswith('PartNumber')]
+            etag = store.complete_upload(query['uploadId'], parts)
+            self._send(200, self._xml('CompleteMultipartUploadResult',
+                                      {'Bucket': bucket, 'Key': key, 'ETag': etag}))
+        else:
+            self._send(400)
+
+    def do_GET(self):
+        bucket, key, _query = self._target()
+        found = self.server.store.get(bucket, key)
+        if found is None:
+            self._send(404, self._xml('Error', {'Code': 'NoSuchKey'}))
+            return
+        data, content_type, etag = found
+        self._send(200, data, {'Content-Type': content_type or 'binary/octet-stream', 'ETag': etag})
+
+    def do_HEAD(self):
+        bucket, key, _query = self._target()
+        if not key:
+            self._send(200 if bucket in self.server.store.buckets else 404)
+            return
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ObjectStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = set()
+        self.objects = {}
+        self.uploads = {}
+
+    def create_bucket(self, bucket):
+        with self.lock:
+            self.buckets.add(bucket)
+
+    def put(self, bucket, key, data, content_type):
+        etag = '"{}"'.format(uuid.uuid4().hex)
+        with self.lock:
+            self.buckets.add(bucket)
+            self.objects[bucket, key] = (data, content_type, etag)
+        return etag
+
+    def get(self, bucket, key):
+        with self.lock:
+            return self.objects.get((bucket, key))
+
+    def create_upload(self, bucket, key, content_type):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = (bucket, key, content_type, {})
+        return upload_id
+
+    def put_part(self, upload_id, number, data):
+        with self.lock:
+            self.uploads[upload_id][3][number] = data
+        return '"{}-{}"'.format(upload_id, number)
+
+    def complete_upload(self, upload_id, numbers):
+        with self.lock:
+            bucket, key, content_type, parts = self.uploads.pop(upload_id)
+        return self.put(bucket, key, b''.join(parts[n] for n in numbers), content_type)
+
+
+class LocalS3(ThreadingHTTPServer):
+    """In-memory S3 stand-in on localhost, for use with `make_s3_client(endpoint_url=...)`."""
+
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), _LocalS3Handler)
+        self.store = _ObjectStore()
+        self.thread = None
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def upload_training_data(filepath, encoder, splitter, uploader, prefix='FlightDelays', formats=('recordio',),
+                         shard_rows=500000, workdir=None, chunksize=CHUNK_SIZE):
+    """Split, encode and export `filepath` into shards that upload while the rest is written.
+
+    Returns the sink reports (with each side's S3 prefix) and the upload
+    throughput.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='flights-shards-')
+
+    def sink_factory(basename):
+        side = os.path.basename(basename)
+        return ShardedSink(basename, encoder.feature_names, formats, uploader,
+                           '{}/{}'.format(prefix, side), shard_rows)
+
+    started = time.perf_counter()
+    reports = split_and_export(filepath, encoder, splitter, formats,
+                               train_out=os.path.join(workdir, 'train'),
+                               test_out=os.path.join(workdir, 'test'),
+                               chunksize=chunksize, sink_factory=sink_factory)
+    reports['upload'] = uploader.wait()
+    reports['seconds'] = round(time.perf_counter() - started, 3)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split Flights.csv and stream the shards to S3.')
+    parser.add_argument('filepath', nargs='?', default='Flights.csv')
+    parser.add_argument('--bucket', help='target bucket (default: the first bucket, as in the lab)')
+    parser.add_argument('--prefix', default='FlightDelays')
+    parser.add_argument('--endpoint-url', help='S3-compatible endpoint instead of AWS')
+    parser.add_argument('--local-s3', action='store_true', help='upload to an in-process S3 stand-in')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['recordio'])
+    parser.add_argument('--mode', choices=MODES, default='random')
+    parser.add_argument('--train-frac', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cutoff', type=parse_cutoff, help="first MM-DD of the test period ('time' mode)")
+    parser.add_argument('--shard-rows', type=int, default=500000)
+    parser.add_argument('--max-files', type=int, default=4, help='shards uploading at once')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='parts in flight per shard')
+    parser.add_argument('--part-mb', type=int, default=8)
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--encoder', default='encoder.json', help='where to save the fitted encoder')
+    args = parser.parse_args(argv)
+    if args.mode == 'time' and args.cutoff is None:
+        parser.error("--mode time needs --cutoff MM-DD")
+
+    local = LocalS3().__enter__() if args.local_s3 else None
+    endpoint_url = local.endpoint_url if local else args.endpoint_url
+    client = make_s3_client(endpoint_url, max_pool_connections=args.max_files * args.max_concurrency)
+    bucket = args.bucket or ('flights' if local else client.list_buckets()['Buckets'][0]['Name'])
+    if local:
+        client.create_bucket(Bucket=bucket)
+
+    workdir = tempfile.mkdtemp(prefix='flights-shards-')
+    try:
+        encoder = SparseOneHotEncoder().fit(read_flights(args.filepath, args.chunksize))
+        encoder.save(args.encoder)
+        uploader = ShardUploader(bucket, client, max_files=args.max_files,
+                                 multipart_chunksize=args.part_mb * MB, multipart_threshold=args.part_mb * MB,
+                                 max_concurrency=args.max_concurrency, delete_uploaded=True)
+        splitter = StreamSplitter(args.mode, args.train_frac, args.seed, args.cutoff)
+        reports = upload_training_data(args.filepath, encoder, splitter, uploader, args.prefix, args.formats,
+                                       args.shard_rows, workdir, args.chunksize)
+        print(json.dumps(reports, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if local:
+            local.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    main()